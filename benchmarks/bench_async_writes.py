@@ -0,0 +1,41 @@
+import argparse
+import asyncio
+import tempfile
+import time
+
+from clayutil.futil import Downloader
+from local_server import LocalServer
+
+
+async def heartbeat(interval: float, lags: list[float]) -> None:
+    # how late the event loop wakes up tells how long it was blocked
+    while True:
+        begin = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - begin - interval)
+
+
+async def bench(base_url: str, output_dir: str, n: int, concurrency: int, chunk_size: int) -> tuple[float, float, float]:
+    d = Downloader(output_dir, chunk_size=chunk_size)
+    lags: list[float] = []
+    monitor = asyncio.create_task(heartbeat(0.005, lags))
+    begin = time.perf_counter()
+    total = 0
+    async for _url, _path in d.download_many(["%sfile%d.bin" % (base_url, i) for i in range(n)], concurrency=concurrency):
+        total += d.history[-1].content_length
+    elapsed = time.perf_counter() - begin
+    monitor.cancel()
+    return n / elapsed, total / elapsed / 1024 / 1024, max(lags, default=0.0) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=200)
+    parser.add_argument("--size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    with LocalServer(b"x" * args.size) as server:
+        for chunk_size in (1024, 64 * 1024, Downloader.CHUNK_SIZE):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                files_per_sec, mb_per_sec, max_lag = asyncio.run(bench(server.url, tmp_dir, args.n, args.concurrency, chunk_size))
+            print("chunk %7d B: %6.1f files/sec, %7.1f MB/sec, max event loop lag %6.1f ms" % (chunk_size, files_per_sec, mb_per_sec, max_lag))
@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import orjson
+
+from clayutil.futil import Downloader
+from local_server import LocalServer
+
+MODES = ("start", "start_segments", "async_start", "download_many", "fetch_bytes")
+
+
+def run_start(d: Downloader, urls: list[str], concurrency: int, segments: int = 1) -> None:
+    if concurrency == 1:
+        for url in urls:
+            d.start(url, segments=segments)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _path in executor.map(lambda url: d.start(url, segments=segments), urls):
+            pass
+
+
+async def run_async_start(d: Downloader, urls: list[str], concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def download(url: str) -> None:
+        async with semaphore:
+            await d.async_start(url, session=session)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, trace_configs=[Downloader.trace_config()]) as session:
+        await asyncio.gather(*(download(url) for url in urls))
+
+
+async def run_download_many(d: Downloader, urls: list[str], concurrency: int) -> None:
+    async for _url, _path in d.download_many(urls, concurrency=concurrency):
+        pass
+
+
+def run_fetch_bytes(d: Downloader, urls: list[str], concurrency: int) -> None:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _data in executor.map(d.fetch_bytes, urls):
+            pass
+
+
+def bench(mode: str, server: LocalServer, size: int, concurrency: int, n: int, mirrors: bool) -> dict:
+    urls = ["%sbytes/%d/%s/file%d.bin" % (server.url, size, mode, i) for i in range(n)]
+    # the dead and the unreachable mirrors are probed and skipped, the live one serves the files
+    mirror_list = {server.url: ["%sdead/" % server.url, "%sdrop/" % server.url, "%s" % server.url.replace("127.0.0.1", "localhost")]} if mirrors else None
+    output_dir = tempfile.mkdtemp()
+    try:
+        with Downloader(output_dir, mirror_list) as d:
+            begin = time.perf_counter()
+            if mode == "start":
+                run_start(d, urls, concurrency)
+            elif mode == "start_segments":
+                run_start(d, urls, concurrency, segments=4)
+            elif mode == "async_start":
+                asyncio.run(run_async_start(d, urls, concurrency))
+            elif mode == "download_many":
+                asyncio.run(run_download_many(d, urls, concurrency))
+            else:
+                run_fetch_bytes(d, urls, concurrency)
+            elapsed = time.perf_counter() - begin
+            ttfb = d.metrics.histogram("ttfb")
+    finally:
+        shutil.rmtree(output_dir)
+    return {
+        "mode": mode,
+        "size": size,
+        "concurrency": concurrency,
+        "files": n,
+        "seconds": elapsed,
+        "files_per_sec": n / elapsed,
+        "mb_per_sec": n * size / elapsed / 1024 / 1024,
+        "ttfb_p50_ms": ttfb.percentile(50) * 1000,
+        "ttfb_p99_ms": ttfb.percentile(99) * 1000,
+    }
+
+
+def compare(results: list[dict], baseline_filename: str, tolerance: float) -> list[str]:
+    """
+    :return: the results slower than the baseline by more than tolerance
+    """
+    with open(baseline_filename, "rb") as fj:
+        baseline = {(r["mode"], r["size"], r["concurrency"]): r for r in orjson.loads(fj.read())["results"]}
+    regressions = []
+    for r in results:
+        before = baseline.get((r["mode"], r["size"], r["concurrency"]))
+        if before is not None and r["files_per_sec"] < before["files_per_sec"] * (1 - tolerance):
+            regressions.append("%s, %d B, concurrency %d: %.1f -> %.1f files/sec" % (r["mode"], r["size"], r["concurrency"], before["files_per_sec"], r["files_per_sec"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Downloader against a local server")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[16 * 1024, 1024 * 1024, 16 * 1024 * 1024])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--bytes-per-run", type=int, default=64 * 1024 * 1024, help="the number of files of a run is chosen to transfer about this many bytes")
+    parser.add_argument("--max-files", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every response")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes per second of every response, 0 for no limit")
+    parser.add_argument("--no-ranges", action="store_true")
+    parser.add_argument("--no-etag", action="store_true")
+    parser.add_argument("--mirrors", action="store_true", help="serve the files through a dead, an unreachable and a live mirror")
+    parser.add_argument("--output", default="bench_downloader.json")
+    parser.add_argument("--baseline", help="a previous output to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = []
+    with LocalServer(latency=args.latency, bandwidth=args.bandwidth, ranges=not args.no_ranges, etag=not args.no_etag) as server:
+        for size in args.sizes:
+            n = max(1, min(args.max_files, args.bytes_per_run // size))
+            for concurrency in args.concurrency:
+                for mode in args.modes:
+                    result = bench(mode, server, size, concurrency, n, args.mirrors)
+                    results.append(result)
+                    print("%-14s %9d B  x%-4d %4d files: %8.1f files/sec, %8.1f MB/sec, ttfb p50 %6.1f ms" % (mode, size, concurrency, n, result["files_per_sec"], result["mb_per_sec"], result["ttfb_p50_ms"]))
+
+    with open(args.output, "wb") as fj:
+        fj.write(
+            orjson.dumps(
+                {
+                    "environment": {"python": sys.version, "platform": platform.platform(), "cpus": os.cpu_count()},
+                    "config": vars(args),
+                    "results": results,
+                },
+                option=orjson.OPT_INDENT_2,
+            )
+        )
+    if args.baseline is not None:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print("regression: %s" % regression)
+        sys.exit(1 if regressions else 0)
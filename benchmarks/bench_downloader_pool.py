@@ -0,0 +1,38 @@
+import argparse
+import os
+import tempfile
+import time
+
+import requests
+
+from clayutil.futil import Downloader
+from local_server import LocalServer
+
+
+def bench_fresh_connections(base_url: str, output_dir: str, n: int) -> float:
+    # what Downloader.start did before: a new connection for every file
+    begin = time.perf_counter()
+    for i in range(n):
+        with requests.get("%sfile%d.bin" % (base_url, i), stream=True) as r, open(os.path.join(output_dir, "file%d.bin" % i), "wb") as fb:
+            fb.write(r.raw.read())
+    return n / (time.perf_counter() - begin)
+
+
+def bench_pooled_session(base_url: str, output_dir: str, n: int) -> float:
+    with Downloader(output_dir) as d:
+        begin = time.perf_counter()
+        for i in range(n):
+            d.start("%sfile%d.bin" % (base_url, i))
+        return n / (time.perf_counter() - begin)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=500)
+    parser.add_argument("--size", type=int, default=1024)
+    args = parser.parse_args()
+    with LocalServer(b"x" * args.size) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        before = bench_fresh_connections(server.url, tmp_dir, args.n)
+        after = bench_pooled_session(server.url, tmp_dir, args.n)
+    print("fresh connections: %.1f requests/sec" % before)
+    print("pooled session:    %.1f requests/sec" % after)
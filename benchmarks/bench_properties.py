@@ -0,0 +1,118 @@
+import argparse
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import orjson
+
+from clayutil.futil import LazyProperties, Properties, _infer_property_value
+
+PATTERN = re.compile(r"^([^#]+?)=(.+)\n$")
+
+
+def write_file(filename: str, lines: int) -> None:
+    with open(filename, "w", encoding="utf-8") as pf:
+        for i in range(lines):
+            if i % 20 == 0:
+                pf.write("# section %d\n" % i)
+            elif i % 3 == 0:
+                pf.write("key.%d=%d\n" % (i, i))
+            elif i % 7 == 0:
+                pf.write("flag.%d=%s\n" % (i, "true" if i % 2 else "false"))
+            else:
+                pf.write("key.%d=some value of line %d\n" % (i, i))
+
+
+def load_regex(filename: str) -> None:
+    """The parser Properties.load used before, for comparison."""
+    properties = Properties(filename)
+    with open(filename, "r", encoding="utf-8") as pf:
+        for i, line in enumerate(pf, 1):
+            m = PATTERN.match(line)
+            if m is None:
+                if line[0] != "#":
+                    continue
+                OrderedDict.__setitem__(properties, "#%i" % i, line)
+            else:
+                OrderedDict.__setitem__(properties, m.group(1), _infer_property_value(m.group(2), True))
+
+
+def load(filename: str, cache: bool = False) -> None:
+    Properties(filename, cache=cache).load()
+
+
+def load_lazy(filename: str) -> None:
+    with LazyProperties(filename) as lp:
+        lp.load()
+
+
+def timed(func, *args, repeat: int) -> float:
+    """:return: the best of the runs, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - begin)
+    return best
+
+
+def bench(directory: str, lines: int, repeat: int, files: int) -> dict:
+    filename = os.path.join(directory, "%d.properties" % lines)
+    write_file(filename, lines)
+    results = {
+        "lines": lines,
+        "bytes": os.path.getsize(filename),
+        "regex": timed(load_regex, filename, repeat=repeat),
+        "partition": timed(load, filename, repeat=repeat),
+        "lazy": timed(load_lazy, filename, repeat=repeat),
+    }
+    load(filename, cache=True)
+    results["cache_warm"] = timed(load, filename, True, repeat=repeat)
+
+    filenames = [filename]
+    for i in range(1, files):
+        filenames.append(os.path.join(directory, "%d.%d.properties" % (lines, i)))
+        shutil.copyfile(filename, filenames[-1])
+    results["files"] = files
+    results["serial_many"] = timed(lambda: [load(f) for f in filenames], repeat=repeat)
+    results["load_many"] = timed(Properties.load_many, filenames, repeat=repeat)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the parsing of properties files")
+    parser.add_argument("--lines", nargs="+", type=int, default=[1000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--files", type=int, default=8, help="the number of files for load_many")
+    parser.add_argument("--output", default="bench_properties.json")
+    args = parser.parse_args()
+
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        for lines in args.lines:
+            result = bench(directory, lines, args.repeat, args.files)
+            results.append(result)
+            print(
+                "%8d lines: regex %8.1f ms, partition %8.1f ms, lazy %8.1f ms, warm cache %8.1f ms, %d files serial %8.1f ms, load_many %8.1f ms"
+                % (lines, result["regex"] * 1000, result["partition"] * 1000, result["lazy"] * 1000, result["cache_warm"] * 1000, args.files, result["serial_many"] * 1000, result["load_many"] * 1000)
+            )
+    finally:
+        shutil.rmtree(directory)
+
+    with open(args.output, "wb") as fj:
+        fj.write(
+            orjson.dumps(
+                {
+                    "environment": {"python": sys.version, "platform": platform.platform(), "cpus": os.cpu_count()},
+                    "config": vars(args),
+                    "results": results,
+                },
+                option=orjson.OPT_INDENT_2,
+            )
+        )
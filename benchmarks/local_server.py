@@ -0,0 +1,132 @@
+import hashlib
+import multiprocessing
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SIZED_PATH_PATTERN = re.compile(r"^/bytes/(\d+)/")
+RANGE_PATTERN = re.compile(r"^bytes=(\d+)-(\d*)$")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def _respond(self, with_body: bool):
+        server: LocalServer = self.server.local_server  # type: ignore[attr-defined]
+        if server.latency > 0:
+            time.sleep(server.latency)
+        if self.path.startswith("/drop/"):
+            # a mirror which accepts the connection but never answers
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if self.path.startswith("/dead/"):
+            self._send_empty(503)
+            return
+
+        payload, etag = server.payload_for(self.path)
+        if server.etag and self.headers.get("If-None-Match") == etag:
+            self._send_empty(304)
+            return
+        begin, end = 0, len(payload) - 1
+        byte_range = RANGE_PATTERN.match(self.headers.get("Range", "")) if server.ranges else None
+        if byte_range is not None and self.headers.get("If-Range", etag) == etag:
+            begin = int(byte_range.group(1))
+            end = min(int(byte_range.group(2) or end), end)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (begin, end, len(payload)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - begin + 1))
+        if server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if server.etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        if with_body:
+            self._send_body(memoryview(payload)[begin : end + 1], server.bandwidth)
+
+    def _send_empty(self, code: int):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_body(self, body: memoryview, bandwidth: int):
+        if bandwidth <= 0:
+            self.wfile.write(body)
+            return
+        # paced in slices of 10 ms
+        slice_size = max(1, bandwidth // 100)
+        begin = time.perf_counter()
+        for i in range(0, len(body), slice_size):
+            self.wfile.write(body[i : i + slice_size])
+            delay = begin + (i + slice_size) / bandwidth - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer(object):
+    """
+    A local HTTP/1.1 server standing in for the hosts and the mirrors of Downloader.
+
+    Every path serves the same payload, except:
+        /bytes/<n>/...  serves n bytes
+        /dead/...       answers "503 Service Unavailable", like a broken mirror
+        /drop/...       closes the connection without answering, like an unreachable mirror
+
+    Byte ranges (with If-Range) and ETags (with If-None-Match) can be switched off,
+    latency delays every response, and bandwidth paces every body, in bytes per second.
+
+    Where fork is available, it is served from a child process,
+    so that the server does not compete with the benchmarked client for the GIL.
+    """
+
+    def __init__(self, payload: bytes = b"x" * 1024, latency: float = 0.0, bandwidth: int = 0, ranges: bool = True, etag: bool = True):
+        self.payload: bytes = payload
+        self.latency: float = latency
+        self.bandwidth: int = bandwidth
+        self.ranges: bool = ranges
+        self.etag: bool = etag
+        self._payloads: dict[int, tuple[bytes, str]] = {}  # size: (payload, etag)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.local_server = self  # type: ignore[attr-defined]
+        self.url = "http://127.0.0.1:%d/" % self.httpd.server_address[1]
+        if "fork" in multiprocessing.get_all_start_methods():
+            self._worker = multiprocessing.get_context("fork").Process(target=self.httpd.serve_forever, daemon=True)
+        else:
+            self._worker = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def payload_for(self, path: str) -> tuple[bytes, str]:
+        sized = SIZED_PATH_PATTERN.match(path)
+        size = int(sized.group(1)) if sized is not None else -1
+        if size not in self._payloads:
+            payload = b"x" * size if size >= 0 else self.payload
+            self._payloads[size] = (payload, '"%s"' % hashlib.md5(payload).hexdigest())
+        return self._payloads[size]
+
+    def __enter__(self) -> "LocalServer":
+        self._worker.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if isinstance(self._worker, threading.Thread):
+            self.httpd.shutdown()
+        else:
+            self._worker.terminate()
+            self._worker.join()
+        self.httpd.server_close()
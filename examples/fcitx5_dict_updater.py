@@ -13,7 +13,9 @@ class Fcitx5DictUpdater(UserDict):
     data: Dict[str, str]  # {词库名(文件名): 词库URL地址}
 
     def download_dicts(self):
-        d = Downloader(os.path.join(pathlib.Path.home(), ".local/share/fcitx5/pinyin/dictionaries/"))
+        dicts_dir = os.path.join(pathlib.Path.home(), ".local/share/fcitx5/pinyin/dictionaries/")
+        # 未变化的词库不会被重新下载
+        d = Downloader(dicts_dir, cache_index=os.path.join(dicts_dir, ".downloader_cache.sqlite3"))
         for dict_name, dict_url in self.data.items():
             print(dict_name, dict_url)
             d.start(dict_url, dict_name, proxies=custom_proxies)
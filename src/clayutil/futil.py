@@ -1,53 +1,566 @@
 import asyncio
+import contextlib
 import functools
+import hashlib
+import heapq
+import itertools
+import marshal
+import math
+import mmap
 import os
 import re
 import shutil
+import sqlite3
+import struct
+import tempfile
+import time
 import zipfile
-from collections import OrderedDict, defaultdict
-from concurrent.futures import ThreadPoolExecutor
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from email.message import EmailMessage
 from email.utils import collapse_rfc2231_value
-from threading import Lock, Timer
-from typing import Callable, Literal, Optional, Union
+from threading import Condition, Event, Lock, Thread, local
+from typing import AsyncIterator, BinaryIO, Callable, Collection, Iterable, Iterator, Literal, Mapping, NamedTuple, Optional, Union
+from urllib.parse import urlsplit
 
 import aiohttp
+import orjson
 import requests
 from filelock import FileLock
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
 from watchdog.events import DirMovedEvent, FileMovedEvent, FileSystemEventHandler
 from watchdog.observers import Observer
 
 __all__ = (
     "check_duplicate_filename",
+    "FilenameAllocator",
     "compress_as_zip",
+    "stream_zip",
+    "iter_zip",
+    "extract_zip",
     "PropertiesValueError",
     "Properties",
+    "LazyProperties",
+    "PropertiesCache",
+    "DownloadError",
+    "DigestMismatchError",
+    "DownloadRecord",
+    "DownloadHistory",
+    "RingHistory",
+    "SQLiteHistory",
+    "DownloadCache",
+    "ContentStore",
+    "ByteCache",
+    "MirrorSelector",
+    "TokenBucket",
+    "TransferScheduler",
+    "TransferMetrics",
+    "Histogram",
+    "MetricsAggregator",
     "Downloader",
     "FolderMonitor",
     "filelock",
 )
 
 
+def _compile_duplicate_pattern(pattern_string: str) -> re.Pattern:
+    return re.compile(r"(.*%s)" % pattern_string.replace("{n}", r")(\d+)("))
+
+
+def _next_duplicate_filename(filename: str, pattern: re.Pattern, pattern_string: str) -> str:
+    splitext_filename = os.path.splitext(filename)
+    m = pattern.match(splitext_filename[0])
+    if m:
+        return "%s%s" % (pattern.sub(lambda m: "%s%d%s" % (m.group(1), int(m.group(2)) + 1, m.group(3)), splitext_filename[0]), splitext_filename[1])
+    return "%s%s%s" % (splitext_filename[0], pattern_string.replace("\\", "").format(n=1), splitext_filename[1])
+
+
+def _list_filenames(directory: str) -> set[str]:
+    try:
+        return {os.path.normcase(filename) for filename in os.listdir(directory or ".")}
+    except FileNotFoundError:
+        return set()
+
+
 def check_duplicate_filename(filename: str, pattern_string: str = r" \({n}\)") -> str:
-    pattern = re.compile(r"(.*%s)" % pattern_string.replace("{n}", r")(\d+)("))
-    if os.path.exists(filename):
-        splitext_filename = os.path.splitext(filename)
-        m = pattern.match(splitext_filename[0])
-        if m:
-            filename = "%s%s" % (pattern.sub(lambda m: "%s%d%s" % (m.group(1), int(m.group(2)) + 1, m.group(3)), splitext_filename[0]), splitext_filename[1])
+    """
+    Get the first unused filename by increasing the number in the pattern.
+
+    The directory is listed once, the candidates are looked up in memory.
+
+    :param filename: the wanted filename
+    :param pattern_string: the pattern of the number, "{n}" stands for the number
+    :return: filename if it is unused, else e.g. "name (1).ext" for "name.ext" and "name (2).ext" for "name (1).ext"
+    """
+    if not os.path.exists(filename):
+        return filename
+    pattern = _compile_duplicate_pattern(pattern_string)
+    used = _list_filenames(os.path.dirname(filename))
+    while True:
+        while os.path.normcase(os.path.basename(filename)) in used:
+            filename = _next_duplicate_filename(filename, pattern, pattern_string)
+        # the listing may be outdated or case-folded differently by the file system
+        if not os.path.exists(filename):
+            return filename
+        used.add(os.path.normcase(os.path.basename(filename)))
+
+
+class FilenameAllocator(object):
+    """
+    A tool for allocating unused filenames in a directory, named like check_duplicate_filename() does.
+
+    Each allocated name is reserved by creating an empty placeholder with O_CREAT | O_EXCL, the wanted name is tried first.
+    Only when it is taken, the directory is listed into an in-memory index of the used names to find the next free one,
+    and listed again on a later collision if its mtime shows that it was changed since.
+    One allocator is shared per directory (see for_directory()),
+    so it is safe for threads and coroutines writing into the same directory,
+    and the exclusive creation keeps it safe against other processes too.
+    """
+
+    _allocators: dict[tuple[str, str], "FilenameAllocator"] = {}
+    _allocators_lock = Lock()
+
+    def __init__(self, directory: str, pattern_string: str = r" \({n}\)"):
+        self.directory: str = directory
+        self.pattern_string: str = pattern_string
+        self._pattern = _compile_duplicate_pattern(pattern_string)
+        self._listed_mtime: Optional[int] = None
+        self._used: Optional[set[str]] = None  # listed on the first collision
+        self._lock = Lock()
+
+    @classmethod
+    def for_directory(cls, directory: str, pattern_string: str = r" \({n}\)") -> "FilenameAllocator":
+        key = (os.path.realpath(directory or "."), pattern_string)
+        with cls._allocators_lock:
+            if key not in cls._allocators:
+                cls._allocators[key] = cls(directory, pattern_string)
+            return cls._allocators[key]
+
+    def __directory_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.directory or ".").st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def __create(filename: str) -> bool:
+        try:
+            os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    def reserve(self, filename: str) -> str:
+        """
+        :param filename: the wanted filename in the directory
+        :return: the reserved filename, an empty file exists there now
+        """
+        with self._lock:
+            # a free name costs a single system call, however large the directory is
+            if self.__create(filename):
+                if self._used is not None:
+                    self._used.add(os.path.normcase(os.path.basename(filename)))
+                return filename
+            # e.g. a downloaded file was deleted, its name is free again
+            mtime = self.__directory_mtime()
+            if self._used is None or mtime != self._listed_mtime:
+                self._listed_mtime = mtime
+                self._used = _list_filenames(self.directory)
+            self._used.add(os.path.normcase(os.path.basename(filename)))
+            while True:
+                while os.path.normcase(os.path.basename(filename)) in self._used:
+                    filename = _next_duplicate_filename(filename, self._pattern, self.pattern_string)
+                self._used.add(os.path.normcase(os.path.basename(filename)))
+                # created by someone else after the directory was listed otherwise, it is in the index now
+                if self.__create(filename):
+                    return filename
+
+    def release(self, filename: str) -> None:
+        """Remove the placeholder of a reserved filename which is no longer needed."""
+        with self._lock:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(filename)
+            if self._used is not None:
+                self._used.discard(os.path.normcase(os.path.basename(filename)))
+
+
+INCOMPRESSIBLE_EXTENSIONS = frozenset(
+    (
+        ".zip", ".gz", ".tgz", ".bz2", ".xz", ".txz", ".zst", ".lz4", ".7z", ".rar",
+        ".jar", ".whl", ".apk", ".docx", ".xlsx", ".pptx", ".odt", ".epub",
+        ".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".heic",
+        ".mp3", ".aac", ".m4a", ".ogg", ".opus", ".flac", ".mp4", ".m4v", ".mkv", ".webm", ".mov", ".avi",
+    )
+)  # fmt: skip
+ZIP_SPOOL_SIZE = 8 * 1024 * 1024  # compressed members up to this size are kept in memory
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+
+def _walk_members(path: str) -> Iterator[tuple[str, str]]:
+    """
+    :return: an iterator of (filename, arcname) of the files under path, in the order of os.walk
+    """
+    for root, _dirs, files in os.walk(path):
+        relpath = os.path.relpath(root, path)
+        for filename in files:
+            yield os.path.join(root, filename), os.path.join(relpath, filename)
+
+
+def _member_compress_type(filename: str, store_extensions: Collection[str]) -> int:
+    return zipfile.ZIP_STORED if os.path.splitext(filename)[1].lower() in store_extensions else zipfile.ZIP_DEFLATED
+
+
+def _compress_member(filename: str, arcname: str, compress_type: int, compresslevel: Optional[int]) -> tuple[zipfile.ZipInfo, BinaryIO]:
+    """
+    Compress a file into a spooled buffer, the way ZipFile.write() would.
+
+    :return: the ZipInfo with the CRC and the sizes filled, and the buffer of the compressed bytes, rewound
+    """
+    zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+    zinfo.compress_type = compress_type
+    compressor = zlib.compressobj(compresslevel if compresslevel is not None else zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if compress_type == zipfile.ZIP_DEFLATED else None
+    crc = 0
+    spool = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)  # noqa: SIM115
+    try:
+        with open(filename, "rb") as fb:
+            while True:
+                chunk = fb.read(ZIP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                zinfo.file_size += len(chunk)
+                spool.write(compressor.compress(chunk) if compressor is not None else chunk)
+        if compressor is not None:
+            spool.write(compressor.flush())
+        zinfo.CRC = crc
+        zinfo.compress_size = spool.tell()
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return zinfo, spool  # type: ignore[return-value]
+
+
+def _write_raw_member(zipf: zipfile.ZipFile, zinfo: zipfile.ZipInfo, fb: BinaryIO) -> None:
+    """
+    Append a member whose CRC, sizes and compressed bytes are already known,
+    laid out as ZipFile.open(zinfo, "w") would do, so that ZipFile.close() writes its central directory entry.
+
+    :param fb: positioned at the first of the zinfo.compress_size compressed bytes
+    """
+    with zipf._lock:
+        zipf._writecheck(zinfo)  # type: ignore[attr-defined]
+        zipf._didModify = True  # type: ignore[attr-defined]
+        zipf.fp.seek(zipf.start_dir)  # type: ignore[union-attr]
+        zinfo.header_offset = zipf.fp.tell()  # type: ignore[union-attr]
+        zipf.fp.write(zinfo.FileHeader(None))  # type: ignore[union-attr]
+        remaining = zinfo.compress_size
+        while remaining > 0:
+            chunk = fb.read(min(ZIP_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile("unexpected end of the compressed bytes of %r" % zinfo.filename)
+            zipf.fp.write(chunk)  # type: ignore[union-attr]
+            remaining -= len(chunk)
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        zipf.start_dir = zipf.fp.tell()  # type: ignore[union-attr]
+
+
+def compress_as_zip(
+    path: str,
+    zip_filename: str,
+    compresslevel: Optional[int] = None,
+    workers: int = 1,
+    store_extensions: Collection[str] = INCOMPRESSIBLE_EXTENSIONS,
+    incremental: bool = False,
+) -> None:
+    """
+    Compress the files under path into a zip archive.
+
+    When workers is greater than 1, the files are deflated at the same time in a thread pool
+    (zlib releases the GIL while compressing), each one into a spooled buffer,
+    and the compressed members are appended to the archive in the order of os.walk.
+
+    When incremental is True, a "<zip_filename>.manifest.json" sidecar records the size, the mtime and the CRC of every member.
+    On the next run, the members whose file has the same size and mtime are copied from the previous archive
+    as raw compressed bytes, without being decompressed, and only the new and the changed files are compressed.
+    The archive is rebuilt into a temporary file which replaces the previous one when it is complete.
+
+    :param path: the directory to compress
+    :param zip_filename: the archive to create
+    :param compresslevel: the deflate level from 0 to 9, the zlib default when None, copied members keep their level
+    :param workers: the number of files compressed at the same time, 0 for the number of CPUs
+    :param store_extensions: the lowercase extensions of the files stored without compression, as they are already compressed
+    :param incremental: whether to reuse the unchanged members of the previous archive
+    """
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    manifest_filename = "%s.manifest.json" % zip_filename
+    previous_manifest = _load_zip_manifest(manifest_filename) if incremental and os.path.isfile(zip_filename) else {}
+    manifest: dict[str, list[int]] = {}  # member name: [size, mtime_ns, CRC]
+    target_filename = "%s.tmp" % zip_filename if incremental else zip_filename
+    try:
+        with contextlib.ExitStack() as stack:
+            previous = stack.enter_context(zipfile.ZipFile(zip_filename)) if previous_manifest else None
+            zipf = stack.enter_context(zipfile.ZipFile(target_filename, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel))
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers)) if workers > 1 else None
+            # the members are written in order, a bounded window of members in flight keeps the memory bounded
+            pending: deque[tuple[os.stat_result, Union[Future, Callable[[], None]]]] = deque()
+            window = 2 * workers if executor is not None else 1
+            try:
+                for filename, arcname in _walk_members(path):
+                    stat = os.stat(filename)
+                    zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+                    previous_zinfo = _unchanged_member(previous, previous_manifest.get(zinfo.filename), zinfo.filename, stat)
+                    if previous_zinfo is not None:
+                        job: Union[Future, Callable[[], None]] = functools.partial(_copy_raw_member, zipf, previous, previous_zinfo, zinfo)  # type: ignore[arg-type]
+                    elif executor is not None:
+                        job = executor.submit(_compress_member, filename, arcname, _member_compress_type(filename, store_extensions), compresslevel)
+                    else:
+                        job = functools.partial(zipf.write, filename, arcname, _member_compress_type(filename, store_extensions))
+                    pending.append((stat, job))
+                    if len(pending) >= window:
+                        _write_pending_member(zipf, manifest, *pending.popleft())
+                while pending:
+                    _write_pending_member(zipf, manifest, *pending.popleft())
+            finally:
+                for _stat, job in pending:
+                    if isinstance(job, Future):
+                        job.cancel()
+                        if not job.cancelled() and job.exception() is None:
+                            job.result()[1].close()
+    except BaseException:
+        if incremental:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(target_filename)
+        raise
+
+    if incremental:
+        os.replace(target_filename, zip_filename)
+        tmp_filename = "%s.tmp" % manifest_filename
+        with open(tmp_filename, "wb") as fj:
+            fj.write(orjson.dumps(manifest))
+        os.replace(tmp_filename, manifest_filename)
+    else:
+        # the archive no longer matches the manifest of a previous incremental run
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(manifest_filename)
+
+
+def _load_zip_manifest(manifest_filename: str) -> dict[str, list[int]]:
+    try:
+        with open(manifest_filename, "rb") as fj:
+            return orjson.loads(fj.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+
+def _unchanged_member(previous: Optional[zipfile.ZipFile], entry: Optional[list[int]], name: str, stat: os.stat_result) -> Optional[zipfile.ZipInfo]:
+    """
+    :return: the member of the previous archive if the file has not changed since it was compressed
+    """
+    if previous is None or entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+        return None
+    previous_zinfo = previous.NameToInfo.get(name)
+    # the archive may have been replaced without its manifest, and encrypted members cannot be copied as they are
+    if previous_zinfo is None or entry[2] != previous_zinfo.CRC or entry[0] != previous_zinfo.file_size or previous_zinfo.flag_bits & 0x1:
+        return None
+    return previous_zinfo
+
+
+def _copy_raw_member(zipf: zipfile.ZipFile, previous: zipfile.ZipFile, previous_zinfo: zipfile.ZipInfo, zinfo: zipfile.ZipInfo) -> None:
+    fp = previous.fp
+    fp.seek(previous_zinfo.header_offset)  # type: ignore[union-attr]
+    header = fp.read(zipfile.sizeFileHeader)  # type: ignore[union-attr]
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("bad local file header of %r" % previous_zinfo.filename)
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    fp.seek(fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)  # type: ignore[union-attr, attr-defined]
+    # a fresh ZipInfo, so that no data descriptor or stale extra field of the previous archive is carried over
+    zinfo.compress_type = previous_zinfo.compress_type
+    zinfo.CRC = previous_zinfo.CRC
+    zinfo.file_size = previous_zinfo.file_size
+    zinfo.compress_size = previous_zinfo.compress_size
+    _write_raw_member(zipf, zinfo, fp)  # type: ignore[arg-type]
+
+
+def _write_pending_member(zipf: zipfile.ZipFile, manifest: dict[str, list[int]], stat: os.stat_result, job: Union[Future, Callable[[], None]]) -> None:
+    if isinstance(job, Future):
+        zinfo, spool = job.result()
+        with spool:
+            _write_raw_member(zipf, zinfo, spool)
+    else:
+        job()
+    written = zipf.filelist[-1]
+    manifest[written.filename] = [stat.st_size, stat.st_mtime_ns, written.CRC]
+
+
+class _ChunkSink(object):
+    """A non-seekable file object keeping the written bytes until they are drained."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_stream_steps(fileobj, path: str, compresslevel: Optional[int], store_extensions: Collection[str]) -> Iterator[None]:
+    """
+    Write the archive chunk by chunk, pausing after each chunk.
+
+    On a non-seekable file object, ZipFile writes the CRC and the sizes in a data descriptor after each member.
+    """
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zipf:
+        for filename, arcname in _walk_members(path):
+            zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+            zinfo.compress_type = _member_compress_type(filename, store_extensions)
+            zinfo._compresslevel = compresslevel  # type: ignore[attr-defined]
+            with open(filename, "rb") as fb, zipf.open(zinfo, "w") as dest:
+                while True:
+                    chunk = fb.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    yield
+    # the central directory
+    yield
+
+
+def stream_zip(path: str, fileobj: BinaryIO, compresslevel: Optional[int] = None, store_extensions: Collection[str] = INCOMPRESSIBLE_EXTENSIONS) -> None:
+    """
+    Write the archive of compress_as_zip() to a file object, which does not need to be seekable,
+    e.g. a socket file or the body of an HTTP response.
+
+    :param path: the directory to compress
+    :param fileobj: a writable binary file object
+    :param compresslevel: see compress_as_zip()
+    :param store_extensions: see compress_as_zip()
+    """
+    for _step in _zip_stream_steps(fileobj, path, compresslevel, store_extensions):
+        pass
+
+
+def iter_zip(path: str, compresslevel: Optional[int] = None, store_extensions: Collection[str] = INCOMPRESSIBLE_EXTENSIONS) -> Iterator[bytes]:
+    """
+    Generate the archive of compress_as_zip() chunk by chunk, without a temporary file.
+
+    The first chunk is produced as soon as the first file is read,
+    and no more than one chunk of a file is held in memory at a time.
+
+    :param path: the directory to compress
+    :param compresslevel: see compress_as_zip()
+    :param store_extensions: see compress_as_zip()
+    :return: an iterator of the bytes of the archive
+    """
+    sink = _ChunkSink()
+    for _step in _zip_stream_steps(sink, path, compresslevel, store_extensions):
+        data = sink.drain()
+        if data:
+            yield data
+
+
+def extract_zip(zip_filename: str, path: str, workers: int = 1, skip_unchanged: bool = False) -> list[str]:
+    """
+    Extract a zip archive into a directory, the members being decompressed at the same time in a thread pool,
+    each worker reading through its own ZipFile handle.
+
+    Every member name is checked before anything is written,
+    and ValueError is raised if one of them is absolute or would land outside of path.
+
+    :param zip_filename: the archive to extract
+    :param path: the directory to extract into
+    :param workers: the number of members decompressed at the same time, 0 for the number of CPUs
+    :param skip_unchanged: whether to keep the existing files whose size and CRC match the members
+    :return: the paths of the extracted files, without the skipped ones
+    """
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    root = os.path.realpath(path)
+    with zipfile.ZipFile(zip_filename) as zipf:
+        members = [(zinfo, _member_target(root, zinfo.filename)) for zinfo in zipf.infolist()]
+    # members with the same name would be written at the same time into one file, the last one wins like with extractall()
+    targets: dict[str, tuple[zipfile.ZipInfo, str]] = {}
+    for zinfo, target in members:
+        if zinfo.is_dir():
+            os.makedirs(target, exist_ok=True)
         else:
-            filename = "%s%s%s" % (splitext_filename[0], pattern_string.replace("\\", "").format(n=1), splitext_filename[1])
-        return check_duplicate_filename(filename)
-    return filename
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            targets[os.path.normcase(target)] = (zinfo, target)
+    # the largest members first, so that one of them does not start last and keep a single worker busy
+    files = sorted(targets.values(), key=lambda member: member[0].file_size, reverse=True)
+
+    thread_state = local()
+    handles: list[zipfile.ZipFile] = []
+    handles_lock = Lock()
+
+    def extract(zinfo: zipfile.ZipInfo, target: str) -> Optional[str]:
+        if skip_unchanged and _same_content(target, zinfo):
+            return None
+        if not hasattr(thread_state, "zipf"):
+            thread_state.zipf = zipfile.ZipFile(zip_filename)
+            with handles_lock:
+                handles.append(thread_state.zipf)
+        with thread_state.zipf.open(zinfo) as src, open(target, "wb") as dst:
+            _preallocate(dst, zinfo.file_size)
+            shutil.copyfileobj(src, dst, ZIP_CHUNK_SIZE)
+            dst.truncate()
+        return target
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            extracted = list(executor.map(lambda member: extract(*member), files))
+    finally:
+        for handle in handles:
+            handle.close()
+    return [target for target in extracted if target is not None]
+
+
+def _member_target(root: str, name: str) -> str:
+    if os.path.isabs(name) or os.path.splitdrive(name)[0] or name.startswith(("/", "\\")):
+        raise ValueError("absolute member name %r" % name)
+    target = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath((root, target)) != root:
+        raise ValueError("member name %r is outside of the target directory" % name)
+    return target
+
+
+def _same_content(filename: str, zinfo: zipfile.ZipInfo) -> bool:
+    try:
+        if os.path.getsize(filename) != zinfo.file_size:
+            return False
+        crc = 0
+        with open(filename, "rb") as fb:
+            while True:
+                chunk = fb.read(ZIP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+    except OSError:
+        return False
+    return crc == zinfo.CRC
 
 
-def compress_as_zip(path: str, zip_filename: str) -> None:
-    with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for root, _dirs, files in os.walk(path):
-            relpath = os.path.relpath(root, path)
-            for filename in files:
-                zipf.write(os.path.join(root, filename), os.path.join(relpath, filename))
+def _preallocate(fb: BinaryIO, size: int) -> None:
+    """Reserve the blocks of the file up front, so that it is laid out contiguously."""
+    if size > 0 and hasattr(os, "posix_fallocate"):
+        # not every file system supports it
+        with contextlib.suppress(OSError):
+            os.posix_fallocate(fb.fileno(), 0, size)
 
 
 class PropertiesValueError(ValueError):
@@ -56,6 +569,72 @@ class PropertiesValueError(ValueError):
 
 PropertiesOrderedDict = OrderedDict[str, Union[int, bool, str]]
 
+PROPERTIES_CACHE_VERSION = 1
+
+
+def _infer_property_value(value: str, infer_integer: bool) -> Union[int, bool, str]:
+    if infer_integer and (value.isdecimal() or value[:1] == "-" and value[1:].isdecimal()):
+        return int(value)
+    elif value == "true":
+        return True
+    elif value == "false":
+        return False
+    else:
+        return value
+
+
+def _parse_properties(text: str, infer_integer: bool) -> list[tuple[str, Union[int, bool, str]]]:
+    """
+    Parse the lines Properties.pattern matches, without the regular expression:
+    the key runs up to the first "=" after the first character, contains no "#", and the value is not empty.
+
+    :param text: the content of the file, with the line endings translated to "\n"
+    """
+    lines = text.split("\n")
+    # the text after the last line ending, only kept if it is a comment
+    tail = lines.pop()
+    items = []
+    append = items.append
+    for i, line in enumerate(lines, 1):
+        key, _sep, value = line.partition("=")
+        if key and value and "#" not in key:
+            append((key, _infer_property_value(value, infer_integer)))
+        elif line[:1] == "#":
+            append(("#%i" % i, line + "\n"))
+        elif not key:
+            # the first character is part of the key, even if it is "="
+            sep = line.find("=", 1)
+            if 0 < sep < len(line) - 1 and "#" not in line[:sep]:
+                append((line[:sep], _infer_property_value(line[sep + 1 :], infer_integer)))
+    if tail[:1] == "#":
+        items.append(("#%i" % (len(lines) + 1), tail))
+    return items
+
+
+def _read_properties(filename: str, encoding: str, infer_integer: bool, cache_filename: Optional[str] = None) -> list[tuple[str, Union[int, bool, str]]]:
+    """
+    :param cache_filename: a sidecar file keeping the parsed items, reused while the mtime and the size of the file are the same
+    """
+    if cache_filename is not None:
+        st = os.stat(filename)
+        cache_key = (PROPERTIES_CACHE_VERSION, st.st_mtime_ns, st.st_size, encoding, infer_integer)
+        try:
+            with open(cache_filename, "rb") as fb:
+                # much faster than marshal.load() on the file object
+                cached_key, items = marshal.loads(fb.read())
+            if cached_key == cache_key:
+                return items
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+    with open(filename, "r", encoding=encoding) as pf:
+        items = _parse_properties(pf.read(), infer_integer)
+    if cache_filename is not None:
+        tmp_filename = "%s.%d.tmp" % (cache_filename, os.getpid())
+        with open(tmp_filename, "wb") as fb:
+            marshal.dump((cache_key, items), fb)
+        os.replace(tmp_filename, cache_filename)
+    return items
+
 
 class Properties(PropertiesOrderedDict):
     """
@@ -63,41 +642,161 @@ class Properties(PropertiesOrderedDict):
 
     a line matches "key=value" will be parsed as a key-value pair,
     while a line starts with "#" will be parsed as a comment.
+
+    The keys changed since the last load() or dump() are tracked, and dump() replaces the file atomically,
+    so a crash leaves either the old or the new file, never a truncated one.
+    With journal=True, dump() only appends the changed keys to <filename>.journal,
+    and the file is rewritten once the journal exceeds journal_limit records.
+    load() replays an existing journal whatever journal is set to, and a rewrite compacts it into the file,
+    but other readers of the file only see the journaled changes once they are compacted.
+    With cache=True, load() keeps the parsed file in <filename>.cache and skips parsing while the file is unchanged.
+    A missing file is created with a date comment, unless create=False, then load() raises FileNotFoundError.
     """
 
+    # the lines parsed as key-value pairs, _parse_properties() matches them without the regular expression
     pattern = re.compile(r"^([^#]+?)=(.+)\n$")
 
-    def __init__(self, filename: str, encoding: str = "utf-8", infer_integer: bool = True):
+    def __init__(self, filename: str, encoding: str = "utf-8", infer_integer: bool = True, journal: bool = False, journal_limit: int = 1000, cache: bool = False, create: bool = True):
         super().__init__()
         self.filename: str = filename
         self.encoding: str = encoding
         self.infer_integer: bool = infer_integer
-        if not os.path.exists(self.filename):
+        self.journal: bool = journal
+        self.journal_limit: int = journal_limit
+        self.journal_filename: str = "%s.journal" % filename
+        self.cache: bool = cache
+        self.cache_filename: str = "%s.cache" % filename
+        # ordered set of the changed keys, a key moves to the end when it is inserted, like in the dict
+        self._dirty: dict[str, None] = {}
+        self._inserted: set[str] = set()  # the changed keys which were inserted, at the end of the dict
+        self._reordered: bool = False  # the order changed in a way the journal can not record
+        self._journal_records: int = 0
+        if create and not os.path.exists(self.filename):
             with open(self.filename, "w", encoding=self.encoding) as pf:
                 pf.write("# %s\n" % datetime.ctime(datetime.now()))
 
+    def __setitem__(self, key: str, value: Union[int, bool, str]) -> None:
+        if key not in self:
+            self._dirty.pop(key, None)
+            self._inserted.add(key)
+        super().__setitem__(key, value)
+        self._dirty[key] = None
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        self._dirty[key] = None
+
+    # the C implementations of these do not go through __delitem__
+    def pop(self, key: str, *default):
+        if key in self:
+            self._dirty[key] = None
+        return super().pop(key, *default)
+
+    def popitem(self, last: bool = True) -> tuple[str, Union[int, bool, str]]:
+        key, value = super().popitem(last)
+        self._dirty[key] = None
+        return key, value
+
+    def clear(self) -> None:
+        super().clear()
+        self._dirty.clear()
+        self._inserted.clear()
+        self._reordered = True
+
+    def move_to_end(self, key: str, last: bool = True) -> None:
+        super().move_to_end(key, last)
+        self._reordered = True
+
+    @classmethod
+    def load_many(cls, filenames: Iterable[str], workers: Optional[int] = None, encoding: str = "utf-8", infer_integer: bool = True, cache: bool = False) -> dict[str, "Properties"]:
+        """
+        Load the files, parsed in parallel by a pool of processes.
+
+        :param workers: the number of processes, defaults to the number of CPUs
+        :return: {filename: properties}
+        """
+        loaded = [cls(filename, encoding, infer_integer, cache=cache) for filename in filenames]
+        filenames = [p.filename for p in loaded]
+        cache_filenames = [p.cache_filename if cache else None for p in loaded]
+        executor = ProcessPoolExecutor(max_workers=workers) if len(loaded) > 1 and workers != 1 else None
+        try:
+            if executor is None:
+                parsed = map(_read_properties, filenames, itertools.repeat(encoding), itertools.repeat(infer_integer), cache_filenames)
+            else:
+                chunksize = max(1, len(loaded) // (4 * (workers or os.cpu_count() or 1)))
+                parsed = executor.map(_read_properties, filenames, itertools.repeat(encoding), itertools.repeat(infer_integer), cache_filenames, chunksize=chunksize)
+            for p, items in zip(loaded, parsed, strict=True):
+                p.__load_items(items)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return dict(zip(filenames, loaded, strict=True))
+
+    @property
+    def dirty_keys(self) -> list[str]:
+        """The keys set or deleted since the last load() or dump()."""
+        return list(self._dirty)
+
     def load(self):
-        with open(self.filename, "r", encoding=self.encoding) as pf:
-            for i, line in enumerate(pf, 1):
-                m = self.pattern.match(line)
-                if m is None:
-                    if line[0] != "#":
-                        continue
-                    self.__setitem__("#%i" % i, line)
-                else:
-                    v: Union[int, bool, str]
-                    if self.infer_integer and (m.group(2).isdecimal() or m.group(2)[:1] == "-" and m.group(2)[1:].isdecimal()):
-                        v = int(m.group(2))
-                    elif m.group(2) == "true":
-                        v = True
-                    elif m.group(2) == "false":
-                        v = False
-                    else:
-                        v = m.group(2)
-                    self.__setitem__(m.group(1), v)
+        self.__load_items(_read_properties(self.filename, self.encoding, self.infer_integer, self.cache_filename if self.cache else None))
+
+    def __load_items(self, items: list[tuple[str, Union[int, bool, str]]]) -> None:
+        for key, value in items:
+            super().__setitem__(key, value)
+        self._journal_records = self.__replay_journal()
+        self._dirty.clear()
+        self._inserted.clear()
+        self._reordered = False
+
+    def __replay_journal(self) -> int:
+        records = 0
+        try:
+            with open(self.journal_filename, "rb") as fj:
+                for line in fj:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # the tail of an interrupted append
+                        break
+                    if len(record) == 2:
+                        super().__setitem__(record[0], record[1])
+                    elif record[0] in self:
+                        super().__delitem__(record[0])
+                    records += 1
+        except FileNotFoundError:
+            pass
+        return records
 
     def dump(self):
-        with open(self.filename, "w", encoding=self.encoding) as pf:
+        # comment keys are line numbers, which a rewrite renumbers, so they are never journaled
+        if self.journal and not self._reordered and self._journal_records + len(self._dirty) <= self.journal_limit and not any(key[0] == "#" for key in self._dirty):
+            if self._dirty:
+                self.__append_journal()
+        else:
+            self.__rewrite()
+        self._dirty.clear()
+        self._inserted.clear()
+        self._reordered = False
+
+    def __append_journal(self) -> None:
+        records = []
+        for key in self._dirty:
+            if key not in self:
+                records.append([key])
+                continue
+            if key in self._inserted:
+                # a key deleted and set again is at the end of the dict, a set alone would leave it where it was on replay
+                records.append([key])
+            records.append([key, self[key]])
+        with open(self.journal_filename, "ab") as fj:
+            fj.write(b"".join(orjson.dumps(record) + b"\n" for record in records))
+            fj.flush()
+            os.fsync(fj.fileno())
+        self._journal_records += len(records)
+
+    def __rewrite(self) -> None:
+        tmp_filename = "%s.tmp" % self.filename
+        with open(tmp_filename, "w", encoding=self.encoding) as pf:
             for key, value in self.items():
                 if key[0] == "#":
                     pf.write("%s" % value)
@@ -105,6 +804,1009 @@ class Properties(PropertiesOrderedDict):
                     if isinstance(value, bool):
                         value = "true" if value else "false"
                     pf.write("%s=%s\n" % (key, value))
+            pf.flush()
+            os.fsync(pf.fileno())
+        os.replace(tmp_filename, self.filename)
+        # the journal is only dropped once the file holds its changes
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.journal_filename)
+        self._journal_records = 0
+
+
+class LazyProperties(Mapping[str, Union[int, bool, str]]):
+    """
+    A read-only, lazily parsed view of a properties file, for very large files.
+
+    load() memory-maps the file and indexes the byte offsets of the values in a single pass,
+    and a value is only decoded and type-inferred when its key is accessed.
+    The keys, the comments ("#<line number>" keys) and the values follow the same rules as Properties,
+    for an ASCII-compatible encoding and "\\n" or "\\r\\n" line endings.
+    The journal of Properties is not replayed, a journaled file is only seen as it was last compacted.
+    """
+
+    pattern = re.compile(rb"^(?:([^#\r\n]+?)=([^\r\n]+)\r?\n|#[^\n]*\n?)", re.M)
+
+    def __init__(self, filename: str, encoding: str = "utf-8", infer_integer: bool = True):
+        self.filename: str = filename
+        self.encoding: str = encoding
+        self.infer_integer: bool = infer_integer
+        self._mm: Union[mmap.mmap, bytes] = b""
+        self._index: dict[str, int] = {}  # key: slot of the value in _spans
+        self._spans: array = array("Q")  # begin, end of each value
+        self._values: dict[str, Union[int, bool, str]] = {}  # the values parsed so far
+
+    def load(self) -> None:
+        self.close()
+        with open(self.filename, "rb") as pf:
+            # an empty file cannot be mapped
+            self._mm = mmap.mmap(pf.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(pf.fileno()).st_size > 0 else b""
+        lineno = 1
+        last = 0
+        for m in self.pattern.finditer(self._mm):
+            key_begin, key_end = m.span(1)
+            if key_begin < 0:
+                lineno += self._mm[last : m.start()].count(b"\n")
+                last = m.start()
+                key = "#%i" % lineno
+                begin, end = m.span()
+            else:
+                key = self._mm[key_begin:key_end].decode(self.encoding)
+                begin, end = m.span(2)
+            if key in self._index:
+                slot = self._index[key]
+                self._spans[2 * slot], self._spans[2 * slot + 1] = begin, end
+            else:
+                self._index[key] = len(self._index)
+                self._spans.append(begin)
+                self._spans.append(end)
+
+    def close(self) -> None:
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._mm = b""
+        self._index.clear()
+        self._spans = array("Q")
+        self._values.clear()
+
+    def __enter__(self) -> "LazyProperties":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __getitem__(self, key: str) -> Union[int, bool, str]:
+        if key in self._values:
+            return self._values[key]
+        slot = self._index[key]
+        raw = self._mm[self._spans[2 * slot] : self._spans[2 * slot + 1]].decode(self.encoding)
+        value = raw.replace("\r\n", "\n") if key[0] == "#" else _infer_property_value(raw, self.infer_integer)
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key) -> bool:
+        return key in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class PropertiesCache(object):
+    """
+    A cache of a loaded properties file, reloaded only when the file changes.
+
+    One cache is shared per file in the process (see for_file()).
+    get() compares the (inode, mtime, size) of the file and of its journal (see Properties) with the loaded ones and reloads it if they differ.
+    Once watch() subscribes the cache to a FolderMonitor, get() trusts the monitor instead and does not even stat the file.
+    A reload replaces the Properties, so the returned object is a consistent snapshot, which should not be modified.
+    The cache never writes the file: while it is missing, the last snapshot is kept, and get() raises FileNotFoundError if there is none.
+    """
+
+    _caches: dict[tuple[str, str, bool], "PropertiesCache"] = {}
+    _caches_lock = Lock()
+
+    def __init__(self, filename: str, encoding: str = "utf-8", infer_integer: bool = True):
+        self.filename: str = os.path.realpath(filename)
+        self.encoding: str = encoding
+        self.infer_integer: bool = infer_integer
+        self._properties: Optional[Properties] = None
+        self._stat: Optional[tuple[Optional[tuple[int, int, int]], Optional[tuple[int, int, int]]]] = None  # (file, journal)
+        self._watched: bool = False
+        self._callbacks: list[Callable[[Properties, list[str]], None]] = []
+        self._lock = Lock()
+
+    @classmethod
+    def for_file(cls, filename: str, encoding: str = "utf-8", infer_integer: bool = True) -> "PropertiesCache":
+        key = (os.path.realpath(filename), encoding, infer_integer)
+        with cls._caches_lock:
+            if key not in cls._caches:
+                cls._caches[key] = cls(filename, encoding, infer_integer)
+            return cls._caches[key]
+
+    def on_change(self, func: Callable[[Properties, list[str]], None]) -> Callable[[Properties, list[str]], None]:
+        """
+        Register a function called with the reloaded properties and the keys added, changed or removed.
+        """
+        self._callbacks.append(func)
+        return func
+
+    def get(self) -> Properties:
+        if self._watched and self._properties is not None:
+            return self._properties
+        return self.reload()
+
+    def reload(self) -> Properties:
+        """
+        Reload the file if it changed since it was loaded.
+
+        :return: the reloaded properties, or the last ones if the file is missing
+        :raise FileNotFoundError: if the file is missing and was never loaded
+        """
+        with self._lock:
+            stat = (self.__stat(self.filename), self.__stat("%s.journal" % self.filename))
+            if self._properties is not None and stat == self._stat:
+                return self._properties
+            properties = Properties(self.filename, self.encoding, self.infer_integer, create=False)
+            try:
+                properties.load()
+            except FileNotFoundError:
+                # e.g. deleted to be replaced, the next change of the file is reloaded since the stat is not updated
+                if self._properties is None:
+                    raise
+                return self._properties
+            previous, self._properties, self._stat = self._properties, properties, stat
+        if previous is not None:
+            # comment keys are line numbers, they are not settings
+            changed_keys = [key for key in previous.keys() | properties.keys() if key[0] != "#" and previous.get(key) != properties.get(key)]
+            if changed_keys:
+                for callback in self._callbacks:
+                    callback(properties, changed_keys)
+        return properties
+
+    @staticmethod
+    def __stat(filename: str) -> Optional[tuple[int, int, int]]:
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def watch(self, monitor: "FolderMonitor") -> None:
+        """
+        Reload the file on the events of the monitor, which should be watching its directory.
+        """
+        # Properties.dump() replaces the file with <filename>.tmp or appends to <filename>.journal
+        watched = {self.filename, "%s.tmp" % self.filename, "%s.journal" % self.filename}
+
+        def handler(event_info: dict) -> None:
+            if os.path.realpath(event_info["src_path"]) in watched or os.path.realpath(event_info.get("dest_path", "")) in watched:
+                self.reload()
+
+        # the monitor only keeps the last event of a path, whatever its type, and the reload is cheap when nothing changed
+        for event_type in ("created", "modified", "moved", "opened", "closed", "closed_no_write"):
+            monitor.on_event(event_type, is_directory=False)(handler)
+        self._watched = True
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DigestMismatchError(DownloadError):
+    pass
+
+
+class _DownloadRecordFields(NamedTuple):
+    url: str
+    filename: str
+    content_length: int
+    content_type: str
+
+
+class DownloadRecord(_DownloadRecordFields):
+    """
+    A record of the download history.
+
+    It unpacks like the (url, filename, content_length, content_type) tuples the history always held,
+    from_cache and digest are only attributes, like the fields os.stat_result adds to its tuple.
+    """
+
+    EXTRA_FIELDS = ("from_cache", "digest")
+
+    from_cache: bool
+    digest: str  # algorithm:hexdigest
+
+    def __new__(cls, url: str, filename: str, content_length: int, content_type: str, from_cache: bool = False, digest: str = ""):
+        record = super().__new__(cls, url, filename, content_length, content_type)
+        record.from_cache = from_cache
+        record.digest = digest
+        return record
+
+    def __getnewargs__(self) -> tuple:
+        return (*self, self.from_cache, self.digest)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, DownloadRecord) and (self.from_cache, self.digest) != (other.from_cache, other.digest):
+            return False
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other) -> bool:
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self) -> int:
+        return hash((*self, self.from_cache, self.digest))
+
+    def __repr__(self) -> str:
+        return "%s, from_cache=%r, digest=%r)" % (super().__repr__()[:-1], self.from_cache, self.digest)
+
+    @classmethod
+    def _make(cls, iterable: Iterable) -> "DownloadRecord":
+        return cls(*iterable)
+
+    def _asdict(self) -> dict:
+        return {**super()._asdict(), "from_cache": self.from_cache, "digest": self.digest}
+
+    def _replace(self, **kwargs) -> "DownloadRecord":
+        return type(self)(**{**self._asdict(), **kwargs})
+
+
+class DownloadHistory(ABC):
+    """
+    The interface of the history backends of Downloader.
+
+    Records are appended by threads and coroutines at the same time, so the backends must be thread-safe.
+    """
+
+    __slots__ = ()
+
+    @abstractmethod
+    def append(self, record: DownloadRecord) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def pop(self) -> DownloadRecord:
+        """Remove and return the latest record."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def __iter__(self) -> Iterator[DownloadRecord]:
+        """Iterate over the records, the oldest first."""
+        raise NotImplementedError
+
+    def __getitem__(self, index: int) -> DownloadRecord:
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("history index out of range")
+        return next(itertools.islice(iter(self), index, None))
+
+
+class RingHistory(DownloadHistory):
+    """
+    A fixed-size in-memory history, the oldest records are dropped first.
+
+    The fields are kept in columns (and the content lengths in an array) instead of one tuple per record.
+    """
+
+    __slots__ = ("maxlen", "_urls", "_filenames", "_content_lengths", "_content_types", "_from_cache", "_digests", "_start", "_size", "_lock")
+
+    def __init__(self, maxlen: int = 1024):
+        if maxlen <= 0:
+            raise ValueError("maxlen must be positive")
+        self.maxlen: int = maxlen
+        self._urls: list[str] = [""] * maxlen
+        self._filenames: list[str] = [""] * maxlen
+        self._content_lengths = array("q", bytes(8 * maxlen))
+        self._content_types: list[str] = [""] * maxlen
+        self._from_cache = bytearray(maxlen)
+        self._digests: list[str] = [""] * maxlen
+        self._start = 0
+        self._size = 0
+        self._lock = Lock()
+
+    def append(self, record: DownloadRecord) -> None:
+        with self._lock:
+            i = (self._start + self._size) % self.maxlen
+            self.__store(i, record)
+            if self._size < self.maxlen:
+                self._size += 1
+            else:
+                self._start = (self._start + 1) % self.maxlen
+
+    def pop(self) -> DownloadRecord:
+        with self._lock:
+            if self._size == 0:
+                raise IndexError("pop from empty history")
+            self._size -= 1
+            i = (self._start + self._size) % self.maxlen
+            record = self.__load(i)
+            self.__store(i, DownloadRecord("", "", 0, ""))
+            return record
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[DownloadRecord]:
+        with self._lock:
+            records = [self.__load((self._start + i) % self.maxlen) for i in range(self._size)]
+        return iter(records)
+
+    def __getitem__(self, index: int) -> DownloadRecord:
+        with self._lock:
+            if index < 0:
+                index += self._size
+            if not 0 <= index < self._size:
+                raise IndexError("history index out of range")
+            return self.__load((self._start + index) % self.maxlen)
+
+    def __store(self, i: int, record: DownloadRecord) -> None:
+        self._urls[i] = record.url
+        self._filenames[i] = record.filename
+        self._content_lengths[i] = record.content_length
+        self._content_types[i] = record.content_type
+        self._from_cache[i] = record.from_cache
+        self._digests[i] = record.digest
+
+    def __load(self, i: int) -> DownloadRecord:
+        return DownloadRecord(self._urls[i], self._filenames[i], self._content_lengths[i], self._content_types[i], bool(self._from_cache[i]), self._digests[i])
+
+
+class SQLiteHistory(DownloadHistory):
+    """
+    A persistent history in an SQLite database, indexed by URL and by filename.
+    """
+
+    def __init__(self, filename: str):
+        self.filename: str = filename
+        self._lock = Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, filename TEXT NOT NULL, content_length INTEGER NOT NULL, "
+                "content_type TEXT NOT NULL, from_cache INTEGER NOT NULL, digest TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS history_url ON history (url)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS history_filename ON history (filename)")
+
+    def append(self, record: DownloadRecord) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO history (url, filename, content_length, content_type, from_cache, digest, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*record, record.from_cache, record.digest, time.time()),
+            )
+
+    def pop(self) -> DownloadRecord:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT id, %s FROM history ORDER BY id DESC LIMIT 1" % self.__columns()).fetchone()
+            if row is None:
+                raise IndexError("pop from empty history")
+            self._conn.execute("DELETE FROM history WHERE id = ?", (row[0],))
+        return self.__record(row[1:])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def __iter__(self) -> Iterator[DownloadRecord]:
+        with self._lock:
+            rows = self._conn.execute("SELECT %s FROM history ORDER BY id" % self.__columns()).fetchall()
+        return map(self.__record, rows)
+
+    def __getitem__(self, index: int) -> DownloadRecord:
+        order, offset = ("DESC", -index - 1) if index < 0 else ("ASC", index)
+        with self._lock:
+            row = self._conn.execute("SELECT %s FROM history ORDER BY id %s LIMIT 1 OFFSET ?" % (self.__columns(), order), (offset,)).fetchone()
+        if row is None:
+            raise IndexError("history index out of range")
+        return self.__record(row)
+
+    def find_by_url(self, url: str) -> list[DownloadRecord]:
+        with self._lock:
+            rows = self._conn.execute("SELECT %s FROM history WHERE url = ? ORDER BY id" % self.__columns(), (url,)).fetchall()
+        return [self.__record(row) for row in rows]
+
+    def find_by_filename(self, filename: str) -> list[DownloadRecord]:
+        with self._lock:
+            rows = self._conn.execute("SELECT %s FROM history WHERE filename = ? ORDER BY id" % self.__columns(), (filename,)).fetchall()
+        return [self.__record(row) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def __columns() -> str:
+        return ", ".join(DownloadRecord._fields + DownloadRecord.EXTRA_FIELDS)
+
+    @staticmethod
+    def __record(row: tuple) -> DownloadRecord:
+        url, filename, content_length, content_type, from_cache, digest = row
+        return DownloadRecord(url, filename, content_length, content_type, bool(from_cache), digest)
+
+
+class DownloadCache(object):
+    """
+    A persistent index of the validators of downloaded files, keyed by URL, in an SQLite database.
+
+    It lets Downloader send conditional requests (If-None-Match, If-Modified-Since),
+    and keep the local file when the server answers "304 Not Modified".
+    Each download updates its own row, so the cost of storing an entry does not grow with the number of entries.
+    """
+
+    COLUMNS = ("filename", "path", "size", "content_type", "digest", "etag", "last_modified")
+
+    def __init__(self, filename: str):
+        self.filename: str = filename
+        self._lock = Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS entries (url TEXT PRIMARY KEY, filename TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, content_type TEXT NOT NULL, digest TEXT NOT NULL, etag TEXT, last_modified TEXT)")
+
+    def lookup(self, url: str, filename: str) -> Optional[dict]:
+        """
+        :return: the entry of the URL if it was downloaded as the same filename and the local file is intact
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT %s FROM entries WHERE url = ?" % ", ".join(self.COLUMNS), (url,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(self.COLUMNS, row, strict=True))
+        if entry["filename"] != filename:
+            return None
+        try:
+            if os.path.getsize(entry["path"]) != entry["size"]:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    @staticmethod
+    def conditional_headers(headers: dict, entry: Optional[dict]) -> dict:
+        if entry is None:
+            return headers
+        conditional_headers = dict(headers)
+        if entry["etag"] is not None:
+            conditional_headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            conditional_headers["If-Modified-Since"] = entry["last_modified"]
+        return conditional_headers
+
+    def store(self, url: str, filename: str, path: str, response_headers, content_type: str, digest: str = "") -> None:
+        etag = response_headers.get("ETag")
+        last_modified = response_headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+            return
+        size = os.path.getsize(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (url, %s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % ", ".join(self.COLUMNS),
+                (url, filename, path, size, content_type, digest, etag, last_modified),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ContentStore(object):
+    """
+    A content-addressed store of downloaded files, keyed by their digests.
+
+    Each distinct content is kept once, as <directory>/<algorithm>/<hexdigest[:2]>/<hexdigest>,
+    and the downloaded files are hard links to these blobs (copies where hard links are not supported, e.g. across file systems).
+    A linked file shares its content with every other file of the same digest,
+    so it should be replaced rather than modified in place.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory: str = directory
+        self._lock = Lock()
+
+    def blob_path(self, digest: str) -> str:
+        """
+        :param digest: "algorithm:hexdigest"
+        """
+        algorithm, _sep, hexdigest = digest.partition(":")
+        return os.path.join(self.directory, algorithm, hexdigest[:2], hexdigest)
+
+    def __contains__(self, digest: str) -> bool:
+        return os.path.isfile(self.blob_path(digest))
+
+    def put(self, filename: str, digest: str) -> str:
+        """
+        Move the file into the store, the file is dropped if the same content is already stored.
+
+        :return: the path of the blob
+        """
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        with self._lock:
+            if os.path.isfile(blob):
+                os.remove(filename)
+            else:
+                # the blob only appears once it is complete
+                tmp_filename = "%s.%d.tmp" % (blob, os.getpid())
+                shutil.move(filename, tmp_filename)
+                os.replace(tmp_filename, blob)
+        return blob
+
+    def link(self, digest: str, filename: str) -> None:
+        """
+        Link the file to the stored content, replacing the existing file atomically.
+        """
+        blob = self.blob_path(digest)
+        tmp_filename = "%s.link" % filename
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_filename)
+        try:
+            os.link(blob, tmp_filename)
+        except OSError:
+            shutil.copyfile(blob, tmp_filename)
+        os.replace(tmp_filename, filename)
+
+
+class ByteCache(object):
+    """
+    A size-bounded LRU cache of response bodies in memory, keyed by URL.
+
+    When the total size exceeds max_size, the least recently used bodies are evicted,
+    and a body expires ttl seconds after it is stored.
+    """
+
+    def __init__(self, max_size: int = 64 * 1024 * 1024, ttl: float = 300.0):
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self.size: int = 0
+        self._entries: OrderedDict[str, tuple[bytes, float]] = OrderedDict()  # url: (data, expires_at), the least recently used first
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, url: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                self.__evict(url)
+                return None
+            self._entries.move_to_end(url)
+            return entry[0]
+
+    def put(self, url: str, data: bytes) -> None:
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            if url in self._entries:
+                self.__evict(url)
+            self._entries[url] = (data, time.monotonic() + self.ttl)
+            self.size += len(data)
+            while self.size > self.max_size:
+                self.__evict(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __evict(self, url: str) -> None:
+        data, _expires_at = self._entries.pop(url)
+        self.size -= len(data)
+
+
+class MirrorSelector(object):
+    """
+    A health table of mirrors shared by the downloads of a Downloader.
+
+    Mirrors are probed with cheap HEAD requests, and the live ones are ranked
+    by the expected time to fetch REFERENCE_SIZE bytes,
+    from the probe latency and the throughput measured by the real transfers.
+    An entry expires after ttl seconds, so a dead mirror is only retried after that.
+    """
+
+    REFERENCE_SIZE = 1024 * 1024
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl: float = ttl
+        self._health: dict[str, list] = {}  # mirror: [alive, latency, throughput, expires_at]
+        self._lock = Lock()
+
+    def expired(self, mirrors: Iterable[str]) -> list[str]:
+        now = time.monotonic()
+        with self._lock:
+            return [mirror for mirror in mirrors if mirror not in self._health or self._health[mirror][3] <= now]
+
+    def update(self, mirror: str, alive: bool, latency: float = 0.0) -> None:
+        with self._lock:
+            throughput = self._health[mirror][2] if mirror in self._health else 0.0
+            self._health[mirror] = [alive, latency, throughput, time.monotonic() + self.ttl]
+
+    def record_transfer(self, mirror: str, size: int, seconds: float) -> None:
+        if size <= 0 or seconds <= 0:
+            return
+        with self._lock:
+            if mirror not in self._health:
+                return
+            throughput = size / seconds
+            # exponential moving average
+            self._health[mirror][2] = throughput if self._health[mirror][2] == 0 else 0.7 * self._health[mirror][2] + 0.3 * throughput
+
+    def rank(self, mirrors: Iterable[str]) -> list[str]:
+        """
+        :return: the live mirrors, the fastest first
+        """
+        with self._lock:
+            live = [(self.__expected_time(self._health[mirror]), i, mirror) for i, mirror in enumerate(mirrors) if mirror in self._health and self._health[mirror][0]]
+        return [mirror for _expected_time, _i, mirror in sorted(live)]
+
+    def __expected_time(self, health: list) -> float:
+        _alive, latency, throughput, _expires_at = health
+        return latency + (self.REFERENCE_SIZE / throughput if throughput > 0 else 0.0)
+
+    def table(self) -> dict[str, tuple[bool, float, float]]:
+        """
+        :return: {mirror: (alive, latency, throughput)}
+        """
+        with self._lock:
+            return {mirror: (health[0], health[1], health[2]) for mirror, health in self._health.items()}
+
+
+class TokenBucket(object):
+    """
+    A token bucket refilled at rate tokens per second, holding at most burst tokens.
+
+    A reservation always succeeds and may leave the bucket in debt,
+    the caller waits the returned delay instead, so that large reservations are not starved by small ones.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate: float = rate
+        self.burst: float = burst if burst is not None else rate
+        self._tokens: float = self.burst
+        self._updated: float = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """
+        :return: how long to wait before using the reserved tokens, in seconds
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+
+class TransferScheduler(object):
+    """
+    Shapes the traffic of a Downloader, shared by the sync and the async downloads.
+
+    Each host has a token bucket of requests per second and one of bytes per second,
+    and all the hosts share a bucket of bytes per second. A rate of 0 means no limit.
+
+    When max_active is greater than 0, at most that many transfers run at the same time,
+    and the free slots are granted to the waiting hosts in turn,
+    so that a host with a long queue or a slow server does not starve the others.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = 0.0,
+        bytes_per_second: float = 0.0,
+        total_bytes_per_second: float = 0.0,
+        max_active: int = 0,
+        host_limits: Optional[dict[str, tuple[float, float]]] = None,
+    ):
+        """
+        :param requests_per_second: the default request rate of a host
+        :param bytes_per_second: the default bandwidth of a host
+        :param total_bytes_per_second: the bandwidth of all the hosts together
+        :param max_active: the maximum number of transfers at the same time, 0 for no limit
+        :param host_limits: {host: (requests_per_second, bytes_per_second)}, overriding the defaults for some hosts
+        """
+        self.requests_per_second: float = requests_per_second
+        self.bytes_per_second: float = bytes_per_second
+        self.max_active: int = max_active
+        self.host_limits: dict[str, tuple[float, float]] = host_limits if host_limits is not None else {}
+        self._total_bytes: Optional[TokenBucket] = TokenBucket(total_bytes_per_second) if total_bytes_per_second > 0 else None
+        self._buckets: dict[str, tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}  # host: (requests, bytes)
+        self._active = 0
+        self._waiters: OrderedDict[str, deque[Callable[[], None]]] = OrderedDict()  # host: notifiers, the next host to serve first
+        self._lock = Lock()
+
+    def request_delay(self, host: str) -> float:
+        """
+        Reserve a request to the host.
+
+        :return: how long to wait before sending it, in seconds
+        """
+        bucket = self.__buckets(host)[0]
+        return bucket.reserve() if bucket is not None else 0.0
+
+    def transfer_delay(self, host: str, size: int) -> float:
+        """
+        Reserve the bandwidth of size bytes received from the host.
+
+        :return: how long to wait before receiving more, in seconds
+        """
+        host_bucket = self.__buckets(host)[1]
+        delays = [bucket.reserve(size) for bucket in (host_bucket, self._total_bytes) if bucket is not None]
+        return max(delays, default=0.0)
+
+    def acquire(self, host: str) -> None:
+        """Wait for a transfer slot, see release()."""
+        granted = Event()
+        if not self.__enqueue(host, granted.set):
+            granted.wait()
+
+    async def async_acquire(self, host: str) -> None:
+        """Wait for a transfer slot without blocking the event loop, see release()."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant() -> None:
+            if not granted.done():
+                granted.set_result(None)
+
+        def notify() -> None:
+            loop.call_soon_threadsafe(grant)
+
+        if self.__enqueue(host, notify):
+            return
+        try:
+            await granted
+        except asyncio.CancelledError:
+            with self._lock:
+                waiting = host in self._waiters and notify in self._waiters[host]
+                if waiting:
+                    self._waiters[host].remove(notify)
+                    if not self._waiters[host]:
+                        del self._waiters[host]
+            if not waiting:
+                # the slot was granted while being cancelled
+                self.release(host)
+            raise
+
+    def release(self, host: str) -> None:
+        """Give the transfer slot back, and grant it to the next waiting host."""
+        with self._lock:
+            self._active -= 1
+            while self._waiters and self._active < self.max_active:
+                next_host, notifiers = next(iter(self._waiters.items()))
+                notify = notifiers.popleft()
+                if notifiers:
+                    self._waiters.move_to_end(next_host)
+                else:
+                    del self._waiters[next_host]
+                self._active += 1
+                notify()
+
+    @contextlib.contextmanager
+    def slot(self, host: str) -> Iterator[None]:
+        self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host)
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self, host: str) -> AsyncIterator[None]:
+        await self.async_acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host)
+
+    def __enqueue(self, host: str, notify: Callable[[], None]) -> bool:
+        """
+        :return: whether the slot is granted right away, otherwise notify is called once it is
+        """
+        with self._lock:
+            if self.max_active <= 0 or (self._active < self.max_active and not self._waiters):
+                self._active += 1
+                return True
+            self._waiters.setdefault(host, deque()).append(notify)
+            return False
+
+    def __buckets(self, host: str) -> tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        with self._lock:
+            if host not in self._buckets:
+                requests_per_second, bytes_per_second = self.host_limits.get(host, (self.requests_per_second, self.bytes_per_second))
+                self._buckets[host] = (
+                    TokenBucket(requests_per_second, max(1.0, requests_per_second)) if requests_per_second > 0 else None,
+                    TokenBucket(bytes_per_second) if bytes_per_second > 0 else None,
+                )
+            return self._buckets[host]
+
+
+class TransferMetrics(NamedTuple):
+    kind: Literal["download", "probe"]
+    url: str  # the requested URL, or the tested URL of a probe
+    source: str  # the URL the response came from
+    mirror: Optional[str]  # the mirror which served the download, or the probed mirror
+    status: int  # 0 if no response was received
+    connect_time: float  # spent on resolving and connecting, 0 on a reused connection
+    ttfb: float  # time to the response headers
+    elapsed: float
+    size: int  # the bytes of the downloaded content, 0 when it is taken from the cache
+    retries: int  # retried requests, including the failed mirrors
+    from_cache: bool
+
+    @property
+    def throughput(self) -> float:
+        return self.size / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class Histogram(object):
+    """
+    A histogram of non-negative values in logarithmic buckets,
+    each one GROWTH times as wide as the previous one,
+    so that a percentile is off by at most that ratio, whatever the scale of the values.
+    """
+
+    GROWTH = 1.25
+
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+        self._zeros: int = 0
+        self._buckets: defaultdict[int, int] = defaultdict(int)  # floor(log(value, GROWTH)): count
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if value <= 0:
+            self._zeros += 1
+        else:
+            self._buckets[math.floor(math.log(value, self.GROWTH))] += 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p: float) -> float:
+        """
+        :param p: from 0 to 100
+        :return: the upper bound of the bucket holding the percentile
+        """
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for upper_bound, count in self.buckets():
+            seen += count
+            if seen >= rank:
+                return min(upper_bound, self.max)
+        return self.max
+
+    def buckets(self) -> list[tuple[float, int]]:
+        """
+        :return: [(upper bound, count)], the zeros first
+        """
+        buckets = [(0.0, self._zeros)] if self._zeros else []
+        buckets.extend((self.GROWTH ** (index + 1), self._buckets[index]) for index in sorted(self._buckets))
+        return buckets
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram()
+        histogram.count, histogram.total, histogram.max, histogram._zeros = self.count, self.total, self.max, self._zeros
+        histogram._buckets.update(self._buckets)
+        return histogram
+
+
+class MetricsAggregator(object):
+    """
+    An observer of TransferMetrics, aggregating them into histograms and counters by kind and by host.
+
+    The host "" stands for all the hosts.
+    """
+
+    FIELDS = ("connect_time", "ttfb", "elapsed", "size", "throughput")
+
+    def __init__(self):
+        self._histograms: defaultdict[tuple[str, str, str], Histogram] = defaultdict(Histogram)  # (kind, host, field): histogram
+        self._counters: defaultdict[tuple[str, str], Counter] = defaultdict(Counter)  # (kind, host): {count, failures, retries, cache_hits}
+        self._mirror_wins: Counter = Counter()
+        self._lock = Lock()
+
+    def __call__(self, metrics: TransferMetrics) -> None:
+        with self._lock:
+            for host in (urlsplit(metrics.source).netloc, ""):
+                counter = self._counters[(metrics.kind, host)]
+                counter["count"] += 1
+                counter["failures"] += metrics.status == 0 or metrics.status >= 400
+                counter["retries"] += metrics.retries
+                counter["cache_hits"] += metrics.from_cache
+                for field in self.FIELDS:
+                    # nothing is transferred on a cache hit
+                    if not (metrics.from_cache and field in ("size", "throughput")):
+                        self._histograms[(metrics.kind, host, field)].add(getattr(metrics, field))
+            if metrics.kind == "download" and metrics.mirror is not None:
+                self._mirror_wins[metrics.mirror] += 1
+
+    def hosts(self, kind: str = "download") -> list[str]:
+        with self._lock:
+            return sorted(host for counter_kind, host in self._counters if counter_kind == kind and host)
+
+    def histogram(self, field: str, kind: str = "download", host: str = "") -> Histogram:
+        """
+        :param field: one of FIELDS
+        :return: a snapshot of the histogram
+        """
+        with self._lock:
+            return self._histograms[(kind, host, field)].copy()
+
+    def counters(self, kind: str = "download", host: str = "") -> dict[str, int]:
+        with self._lock:
+            return dict(self._counters[(kind, host)])
+
+    def mirror_wins(self) -> dict[str, int]:
+        """
+        :return: {mirror: the number of downloads it served}
+        """
+        with self._lock:
+            return dict(self._mirror_wins)
+
+    def summary(self, kind: str = "download", host: str = "") -> dict:
+        """
+        :return: the counters, and {field: {mean, p50, p90, p99, max}}
+        """
+        summary: dict = self.counters(kind, host)
+        for field in self.FIELDS:
+            histogram = self.histogram(field, kind, host)
+            summary[field] = {"mean": histogram.mean, "p50": histogram.percentile(50), "p90": histogram.percentile(90), "p99": histogram.percentile(99), "max": histogram.max}
+        return summary
+
+
+class _ConnectTimer(object):
+    """Records how long the last connect() took on the connection."""
+
+    connect_time: float = 0.0
+
+    def connect(self):
+        begin = time.perf_counter()
+        super().connect()
+        self.connect_time = time.perf_counter() - begin
+
+
+class _TimedHTTPConnection(_ConnectTimer, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_ConnectTimer, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
 
 
 class Downloader(object):
@@ -120,25 +1822,167 @@ class Downloader(object):
     LEGACY_CHROME_UA = "Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.90 Safari/537.36"
     CHROME_UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36"
 
-    def __init__(self, output_dir: str, mirrors: Optional[dict[str, list[str]]] = None):
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    CHUNK_SIZE = 256 * 1024
+    MIN_SEGMENT_SIZE = 1024 * 1024
+    JOURNAL_INTERVAL = 1024 * 1024
+    PROBE_TIMEOUT = 10.0
+    CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+    def __init__(
+        self,
+        output_dir: str,
+        mirrors: Optional[dict[str, list[str]]] = None,
+        pool_size: int = 10,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        mirror_ttl: float = 300.0,
+        cache_index: Optional[str] = None,
+        hash_algorithm: str = "sha256",
+        chunk_size: int = CHUNK_SIZE,
+        history: Optional[DownloadHistory] = None,
+        content_store: Optional[ContentStore] = None,
+        scheduler: Optional[TransferScheduler] = None,
+        byte_cache: Optional[ByteCache] = None,
+    ):
         """
         Initialize the Downloader object.
 
+        All the requests sent by start() share one keep-alive session,
+        so a batch of files from the same host reuses its connections.
+
         :param output_dir: The directory where the downloaded files will be saved.
         :param mirrors: {old_string: [new_string]}
+        :param pool_size: The maximum number of pooled connections kept for each host.
+        :param retries: The number of retries on connection errors and retryable status codes.
+        :param backoff_factor: The exponential backoff factor between retries, in seconds.
+        :param mirror_ttl: How long the health of a probed mirror is trusted, in seconds.
+        :param cache_index: The SQLite database to keep the ETag and Last-Modified of the downloaded files in.
+            When given, a file downloaded before is only transferred again if it has changed on the server.
+        :param hash_algorithm: The hashlib algorithm of the digests recorded in the history.
+        :param chunk_size: The size of the chunks read from the network and written to the disk.
+        :param history: The backend keeping the records of the downloads, the latest 1024 records are kept in memory by default.
+        :param content_store: The store to keep each distinct content once, the downloaded files become links to it.
+        :param scheduler: The rate limits and the fair share of transfer slots between hosts, applied to both start() and async_start().
+        :param byte_cache: The cache of the contents fetched by fetch_bytes() and fetch_stream().
         """
 
         os.makedirs(output_dir, exist_ok=True)
         self.__output_dir: str = output_dir
         self.mirrors: dict[str, list[str]] = mirrors if mirrors is not None else {}
-        self.history: list[tuple[str, str, int, str]] = []  # url, filename, content_length, content_type
+        self.history: DownloadHistory = history if history is not None else RingHistory()
+        self.hash_algorithm: str = hash_algorithm
+        self.chunk_size: int = chunk_size
+        self.cache: Optional[DownloadCache] = DownloadCache(cache_index) if cache_index is not None else None
+        self.mirror_selector: MirrorSelector = MirrorSelector(mirror_ttl)
+        self.content_store: Optional[ContentStore] = content_store
+        self.scheduler: Optional[TransferScheduler] = scheduler
+        self.byte_cache: Optional[ByteCache] = byte_cache
+        self.metrics: MetricsAggregator = MetricsAggregator()
+        self._observers: list[Callable[[TransferMetrics], None]] = [self.metrics]
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=self.RETRY_STATUS_CODES, allowed_methods=("HEAD", "GET"), raise_on_status=False)
+        self.session: requests.Session = self.__create_session(pool_size, retry)
+        # mirror probes must fail fast, a dead mirror should not be retried with backoff
+        self._probe_session: requests.Session = self.__create_session(pool_size, Retry(total=0, raise_on_status=False))
 
-    def start(self, url: str, filename: str = "", headers: Optional[dict] = None, check_duplicate: bool = False, proxies: Optional[dict] = None) -> str:
+    @staticmethod
+    def __create_session(pool_size: int, retry: Retry) -> requests.Session:
+        session = requests.Session()
+        adapter = _TimedHTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def close(self) -> None:
+        """Close the pooled sessions and release their connections, and the cache index."""
+        self.session.close()
+        self._probe_session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def on_metrics(self, func: Callable[[TransferMetrics], None]) -> Callable[[TransferMetrics], None]:
+        """
+        Observer registry decorator.
+
+        The observer is called with the TransferMetrics of every download and every mirror probe,
+        from the thread or the event loop running the transfer, so it should return quickly.
+        The metrics are also aggregated in the metrics attribute.
+        """
+        self._observers.append(func)
+        return func
+
+    @staticmethod
+    def trace_config() -> aiohttp.TraceConfig:
+        """
+        The trace of the connection times, to pass to a ClientSession given to async_start(), see TransferMetrics.connect_time.
+        """
+
+        async def on_connection_create_start(_session, context, _params) -> None:
+            if isinstance(context.trace_request_ctx, dict):
+                context.trace_request_ctx["connect_begin"] = time.perf_counter()
+
+        async def on_connection_create_end(_session, context, _params) -> None:
+            if isinstance(context.trace_request_ctx, dict) and "connect_begin" in context.trace_request_ctx:
+                context.trace_request_ctx["connect_time"] += time.perf_counter() - context.trace_request_ctx.pop("connect_begin")
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return trace_config
+
+    def __emit(self, metrics: TransferMetrics) -> None:
+        for observer in self._observers:
+            observer(metrics)
+
+    @staticmethod
+    def __record_connection(r: requests.Response, timing: dict) -> None:
+        connection = r.raw.connection
+        if isinstance(connection, _ConnectTimer):
+            timing["connect_time"] += connection.connect_time
+            # the next responses on this connection reuse it
+            connection.connect_time = 0.0
+        if r.raw.retries is not None:
+            timing["retries"] += len(r.raw.retries.history)
+
+    def __enter__(self) -> "Downloader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def start(self, url: str, filename: str = "", headers: Optional[dict] = None, check_duplicate: bool = False, proxies: Optional[dict] = None, segments: int = 1, resume: bool = False, digest: Optional[str] = None) -> str:
         """
         Copy the target file to the output directory, and rename it if the filename argument is not None.
 
         When a mirror is used, proxies will be omitted.
 
+        When segments is greater than 1 and the server accepts byte ranges,
+        the file is split into that many ranges which are fetched at the same time
+        (from different mirrors when several of them are alive) and written in place.
+        Otherwise, it falls back to a single stream.
+
+        The content is written to a ".part" file which is renamed when the download completes.
+        When resume is True, a ".part.json" sidecar records the URL, the validator (ETag or Last-Modified)
+        and the bytes written, so that an interrupted download continues with a Range request validated by If-Range,
+        sent as the very first request.
+
+        When the Downloader has a cache index and the file has not changed on the server since the last download,
+        the local file is kept, and the history record is marked as from_cache.
+
+        The content is hashed while it is written, and the digest is recorded in the history.
+        If the expected digest is given and does not match, the ".part" file is removed and DigestMismatchError is raised,
+        the existing file at the target path is left untouched.
+
+        When the Downloader has a content store, the file is a link to the stored content.
+        If the expected digest is given and the content is already stored, only the response headers are read,
+        and the history record is marked as from_cache.
+
+        When the Downloader has a scheduler, the download waits for a transfer slot of the host expected to serve it,
+        the best ranked live mirror or else the host of the URL, and each request and the received bytes are paced
+        by the rate limits of the host actually sending them, after the redirects.
+        The slot is not moved when the transfer falls back to another source.
+
         Renaming rules:
             1. If the filename argument is empty, use the filename according to the url.
             2. If the filename argument does not contain an extension, use the extension from the url.
@@ -149,56 +1993,482 @@ class Downloader(object):
         :param headers: HTTP headers to send with the request
         :param check_duplicate: whether to check for duplicate filenames and rename if necessary
         :param proxies: the proxies to use for the request
+        :param segments: the number of byte ranges to fetch at the same time
+        :param resume: whether to resume the interrupted download of the same URL
+        :param digest: the expected digest as "algorithm:hexdigest", e.g. "sha256:9f86d0...", or a bare hexdigest of hash_algorithm
         :return: the absolute path of the downloaded local file
         """
 
+        if self.scheduler is None:
+            return self.__transfer(url, filename, headers, check_duplicate, proxies, segments, resume, digest)
+        with self.scheduler.slot(self.__source_host(url, headers)):
+            return self.__transfer(url, filename, headers, check_duplicate, proxies, segments, resume, digest)
+
+    def __transfer(self, url: str, filename: str, headers: Optional[dict], check_duplicate: bool, proxies: Optional[dict], segments: int, resume: bool, digest: Optional[str]) -> str:
         if headers is None:
             headers = {"User-Agent": self.CHROME_UA}
+        requested_url = url
+        algorithm, expected_digest = self.__parse_digest(digest)
+
+        candidates = self.__mirror_candidates(url)
+        self.__probe_mirrors(candidates, headers)
+        sources = [candidates[mirror] for mirror in self.mirror_selector.rank(candidates)]
+        cached = self.cache.lookup(requested_url, filename) if self.cache is not None else None
+        # a resumable part file is named after the URL, so that its journal is found before the first request,
+        # which can then already continue it
+        resume_filename = self.__resolve_filename({}, url, filename)
+        journal = self.__read_journal(resume_filename, requested_url) if resume else None
+        request_headers = DownloadCache.conditional_headers(headers, cached)
+        if journal is not None:
+            request_headers = self.__resume_headers(request_headers, journal)
+        timing = {"connect_time": 0.0, "retries": 0}
+        begin = time.perf_counter()
+        mirror, r = self.__open_with_mirrors(candidates, sources, url, request_headers, proxies, timing)
+        ttfb = time.perf_counter() - begin
+        if mirror is not None:
+            proxies = None
+            url = candidates[mirror]
+        else:
+            sources = [url]
+        host = urlsplit(r.url).netloc
+
+        with r:
+            if r.status_code == 304 and cached is not None:
+                cached_digest = self.__verify_cached(cached, algorithm, expected_digest)
+                self.__emit(TransferMetrics("download", requested_url, r.url, mirror, r.status_code, timing["connect_time"], ttfb, time.perf_counter() - begin, 0, timing["retries"], True))
+                self.history.append(DownloadRecord(r.url, cached["path"], cached["size"], cached["content_type"], True, cached_digest))
+                return os.path.abspath(cached["path"])
+
+            processed_filename = self.__resolve_filename(r.headers, r.url, filename)
+
+            allocator = FilenameAllocator.for_directory(os.path.dirname(processed_filename)) if check_duplicate and journal is None else None
+            if allocator is not None:
+                processed_filename = allocator.reserve(processed_filename)
+            part_filename = "%s.part" % (resume_filename if resume else processed_filename)
+
+            try:
+                content_type = str(r.headers.get("Content-Type"))
+                content_length = int(str(r.headers.get("Content-Length", 0)))
+                offset = self.__resume_offset(r.status_code, r.headers, journal)
+                if offset is not None:
+                    content_length = offset + (content_length if r.status_code == 206 else 0)
+                segments = min(segments, content_length // self.MIN_SEGMENT_SIZE)
+                hasher = hashlib.new(algorithm)
+                stored_digest = self.__link_stored(algorithm, expected_digest, part_filename, processed_filename)
+                if stored_digest is not None:
+                    r.close()
+                elif offset is not None and r.status_code == 416:
+                    # the part file was complete, the download was interrupted before it was renamed
+                    r.close()
+                    self.__open_part(part_filename, offset, hasher).close()
+                elif offset is not None:
+                    self.__write_stream(r.raw, part_filename, offset, self.__new_journal(requested_url, r.headers), hasher, host)
+                elif r.status_code in (206, 416):
+                    # the answer does not continue the part file, start over
+                    r.close()
+                    self.__pace(url)
+                    with self.session.get(url, headers=headers, stream=True, allow_redirects=True, proxies=proxies if proxies is not None else {}) as full_r:
+                        full_r.raise_for_status()
+                        self.__write_stream(full_r.raw, part_filename, 0, self.__new_journal(requested_url, full_r.headers), hasher, host)
+                elif content_type[:5] == "text/":
+                    # the text is written as the bytes it was sent in, only the content coding is undone, like r.text did,
+                    # so that the hash and the file agree
+                    r.raw.decode_content = True
+                    self.__write_stream(r.raw, part_filename, 0, None, hasher, host)
+                elif segments > 1 and r.headers.get("Accept-Ranges") == "bytes" and "Content-Encoding" not in r.headers:
+                    r.close()
+                    # the segments must come from the same file as the first response,
+                    # without a validator to check that, they are only fetched from its source
+                    validator = self.__validator(r.headers)
+                    self.__fetch_segments(sources if validator is not None else [url], part_filename, content_length, segments, headers, proxies, validator)
+                    # the segments arrive out of order, so they can only be hashed once assembled
+                    self.__hash_file(hasher, part_filename)
+                else:
+                    self.__write_stream(r.raw, part_filename, 0, self.__new_journal(requested_url, r.headers) if resume else None, hasher, host)
+
+                actual_digest = stored_digest if stored_digest is not None else self.__commit_part(part_filename, processed_filename, hasher, expected_digest)
+            except BaseException:
+                if allocator is not None:
+                    allocator.release(processed_filename)
+                raise
+            elapsed = time.perf_counter() - begin
+            size = os.path.getsize(processed_filename) if stored_digest is None else 0
+            if mirror is not None and stored_digest is None:
+                self.mirror_selector.record_transfer(mirror, size, elapsed)
+            if self.cache is not None:
+                self.cache.store(requested_url, filename, processed_filename, r.headers, content_type, actual_digest)
+            self.__emit(TransferMetrics("download", requested_url, r.url, mirror, r.status_code, timing["connect_time"], ttfb, elapsed, size, timing["retries"], stored_digest is not None))
+            self.history.append(DownloadRecord(r.url, processed_filename, content_length, content_type, stored_digest is not None, actual_digest))
+        return os.path.abspath(processed_filename)
+
+    def fetch_bytes(self, url: str, headers: Optional[dict] = None, proxies: Optional[dict] = None) -> bytes:
+        """
+        Fetch the content into memory without touching the disk, see fetch_stream().
+
+        :return: the content, shared with the byte cache
+        """
+        if self.byte_cache is not None:
+            data = self.byte_cache.get(url)
+            if data is not None:
+                return data
+        return b"".join(self.fetch_stream(url, headers, proxies))
+
+    def fetch_stream(self, url: str, headers: Optional[dict] = None, proxies: Optional[dict] = None) -> Iterator[Union[bytes, memoryview]]:
+        """
+        Fetch the content chunk by chunk without touching the disk.
 
+        The mirrors, the scheduler and the metrics apply as in start().
+        When the Downloader has a byte cache, a content fully read and no larger than the cache is kept in it by URL,
+        and the cached content is served as memoryviews, whatever the headers are.
+
+        :param url: the URL of the target file
+        :param headers: HTTP headers to send with the request
+        :param proxies: the proxies to use for the request
+        :return: an iterator of the decoded chunks of the content
+        """
+        if self.byte_cache is not None:
+            data = self.byte_cache.get(url)
+            if data is not None:
+                view = memoryview(data)
+                for i in range(0, len(view), self.chunk_size):
+                    yield view[i : i + self.chunk_size]
+                return
+
+        if headers is None:
+            headers = {"User-Agent": self.CHROME_UA}
+        with self.scheduler.slot(self.__source_host(url, headers)) if self.scheduler is not None else contextlib.nullcontext():
+            requested_url = url
+            candidates = self.__mirror_candidates(url)
+            self.__probe_mirrors(candidates, headers)
+            sources = [candidates[mirror] for mirror in self.mirror_selector.rank(candidates)]
+            timing = {"connect_time": 0.0, "retries": 0}
+            begin = time.perf_counter()
+            mirror, r = self.__open_with_mirrors(candidates, sources, url, headers, proxies, timing)
+            ttfb = time.perf_counter() - begin
+            if mirror is not None:
+                url = candidates[mirror]
+            host = urlsplit(r.url).netloc
+
+            with r:
+                r.raise_for_status()
+                chunks: Optional[list[bytes]] = [] if self.byte_cache is not None else None
+                size = 0
+                for chunk in r.iter_content(self.chunk_size):
+                    self.__throttle(host, len(chunk))
+                    size += len(chunk)
+                    if chunks is not None:
+                        if size <= self.byte_cache.max_size:
+                            chunks.append(chunk)
+                        else:
+                            # the content cannot be cached anyway
+                            chunks = None
+                    yield chunk
+
+            elapsed = time.perf_counter() - begin
+            if mirror is not None:
+                self.mirror_selector.record_transfer(mirror, size, elapsed)
+            self.__emit(TransferMetrics("download", requested_url, r.url, mirror, r.status_code, timing["connect_time"], ttfb, elapsed, size, timing["retries"], False))
+            if chunks is not None:
+                self.byte_cache.put(requested_url, b"".join(chunks))
+
+    def __source_host(self, url: str, headers: Optional[dict]) -> str:
+        """
+        :return: the host expected to serve the URL, the one of the best ranked live mirror if any
+        """
+        candidates = self.__mirror_candidates(url)
+        self.__probe_mirrors(candidates, headers if headers is not None else {"User-Agent": self.CHROME_UA})
+        ranked = self.mirror_selector.rank(candidates)
+        return urlsplit(candidates[ranked[0]] if ranked else url).netloc
+
+    async def __async_source_host(self, session: aiohttp.ClientSession, url: str, headers: Optional[dict]) -> str:
+        candidates = self.__mirror_candidates(url)
+        expired = self.mirror_selector.expired(candidates)
+        if expired:
+            probe_headers = headers if headers is not None else {"User-Agent": self.CHROME_UA}
+            await asyncio.gather(*(self.__async_probe_mirror(session, mirror, candidates[mirror], probe_headers) for mirror in expired))
+        ranked = self.mirror_selector.rank(candidates)
+        return urlsplit(candidates[ranked[0]] if ranked else url).netloc
+
+    def __mirror_candidates(self, url: str) -> dict[str, str]:
         for old_url, new_urls in self.mirrors.items():
             if old_url in url:
-                for new_url in new_urls:
-                    test_url = url.replace(old_url, new_url)
-                    try:
-                        test_r = requests.get(test_url, headers=headers, stream=True, allow_redirects=True)
-                    except requests.RequestException:
-                        continue
-                    if test_r.status_code == 200:
-                        proxies = None
-                        url = test_url
+                return {new_url: url.replace(old_url, new_url) for new_url in new_urls}
+        return {}
+
+    def __probe_mirrors(self, candidates: dict[str, str], headers: dict) -> None:
+        expired = self.mirror_selector.expired(candidates)
+        if not expired:
+            return
+        with ThreadPoolExecutor(max_workers=len(expired)) as executor:
+            for mirror in expired:
+                executor.submit(self.__probe_mirror, mirror, candidates[mirror], headers)
+
+    def __probe_mirror(self, mirror: str, test_url: str, headers: dict) -> None:
+        self.__pace(test_url)
+        timing = {"connect_time": 0.0, "retries": 0}
+        begin = time.perf_counter()
+        try:
+            # streamed, so that the connection is still attached to the response when it is timed
+            with self._probe_session.head(test_url, headers=headers, stream=True, allow_redirects=True, timeout=self.PROBE_TIMEOUT) as test_r:
+                code = test_r.status_code
+                self.__record_connection(test_r, timing)
+            if code in (405, 501):
+                # HEAD is not allowed, ask for the first byte instead
+                self.__pace(test_url)
+                with self._probe_session.get(test_url, headers=dict(headers, Range="bytes=0-0"), stream=True, allow_redirects=True, timeout=self.PROBE_TIMEOUT) as test_r:
+                    code = test_r.status_code
+                    self.__record_connection(test_r, timing)
+        except requests.RequestException:
+            self.mirror_selector.update(mirror, False)
+            self.__emit(TransferMetrics("probe", test_url, test_url, mirror, 0, timing["connect_time"], 0.0, time.perf_counter() - begin, 0, timing["retries"], False))
+            return
+        latency = time.perf_counter() - begin
+        self.mirror_selector.update(mirror, code in (200, 206), latency)
+        self.__emit(TransferMetrics("probe", test_url, test_url, mirror, code, timing["connect_time"], latency, latency, 0, timing["retries"], False))
+
+    def __open_with_mirrors(self, candidates: dict[str, str], sources: list[str], url: str, headers: dict, proxies: Optional[dict], timing: dict) -> tuple[Optional[str], requests.Response]:
+        # the health table may be out of date for this very file, fall back to the next mirror and finally to the original URL
+        mirrors = {source: mirror for mirror, source in candidates.items()}
+        for source in sources:
+            self.__pace(source)
+            try:
+                r = self.session.get(source, headers=headers, stream=True, allow_redirects=True, proxies={})
+            except requests.RequestException:
+                self.mirror_selector.update(mirrors[source], False)
+                timing["retries"] += 1
+                continue
+            self.__record_connection(r, timing)
+            if r.status_code in (200, 206, 304, 416):
+                return mirrors[source], r
+            r.close()
+            timing["retries"] += 1
+            # a mirror lacking one file is still alive for the others
+            if r.status_code >= 500:
+                self.mirror_selector.update(mirrors[source], False)
+        self.__pace(url)
+        r = self.session.get(url, headers=headers, stream=True, allow_redirects=True, proxies=proxies if proxies is not None else {})
+        self.__record_connection(r, timing)
+        return None, r
+
+    def __write_stream(self, raw, part_filename: str, offset: int, journal: Optional[dict], hasher, host: str) -> None:
+        with self.__open_part(part_filename, offset, hasher) as fb:
+            unjournaled = 0
+            try:
+                while True:
+                    chunk = raw.read(self.chunk_size)
+                    if not chunk:
                         break
+                    fb.write(chunk)
+                    hasher.update(chunk)
+                    self.__throttle(host, len(chunk))
+                    unjournaled += len(chunk)
+                    if journal is not None and unjournaled >= self.JOURNAL_INTERVAL:
+                        self.__write_journal(part_filename, journal, fb)
+                        unjournaled = 0
+            finally:
+                if journal is not None:
+                    self.__write_journal(part_filename, journal, fb)
+
+    @classmethod
+    def __open_part(cls, part_filename: str, offset: int, hasher) -> BinaryIO:
+        fb = open(part_filename, "r+b" if offset else "wb")  # noqa: SIM115
+        try:
+            # the resumed bytes are the only ones read back
+            cls.__hash_file(hasher, fb, offset)
+            fb.truncate()
+        except BaseException:
+            fb.close()
+            raise
+        return fb
+
+    @classmethod
+    def __hash_file(cls, hasher, file: Union[str, BinaryIO], size: int = -1) -> None:
+        if isinstance(file, str):
+            with open(file, "rb") as fb:
+                cls.__hash_file(hasher, fb, size)
+            return
+        while size != 0:
+            chunk = file.read(cls.CHUNK_SIZE if size < 0 else min(cls.CHUNK_SIZE, size))
+            if not chunk:
                 break
+            hasher.update(chunk)
+            size -= len(chunk)
+
+    def __parse_digest(self, digest: Optional[str]) -> tuple[str, Optional[str]]:
+        if digest is None:
+            return self.hash_algorithm, None
+        algorithm, _sep, hexdigest = digest.rpartition(":")
+        return (algorithm or self.hash_algorithm).lower(), hexdigest.lower()
+
+    def __commit_part(self, part_filename: str, processed_filename: str, hasher, expected_digest: Optional[str]) -> str:
+        if expected_digest is not None and hasher.hexdigest() != expected_digest:
+            for leftover in (part_filename, "%s.json" % part_filename):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(leftover)
+            raise DigestMismatchError("expected %s digest of %r to be %s, got %s" % (hasher.name, processed_filename, expected_digest, hasher.hexdigest()))
+        actual_digest = "%s:%s" % (hasher.name, hasher.hexdigest())
+        if self.content_store is None:
+            os.replace(part_filename, processed_filename)
+        else:
+            self.content_store.put(part_filename, actual_digest)
+            self.content_store.link(actual_digest, processed_filename)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove("%s.json" % part_filename)
+        return actual_digest
 
-        with requests.get(url, headers=headers, stream=True, allow_redirects=True, proxies=proxies if proxies is not None else {}) as r:
-            try:
-                msg = EmailMessage()
-                msg["Content-Disposition"] = r.headers["content-disposition"]
-                _raw_param = msg.get_param("filename*", header="Content-Disposition")
-                if _raw_param is None:
-                    raise KeyError
-                processed_filename = os.path.join(self.__output_dir, collapse_rfc2231_value(_raw_param).strip('"'))
-            except (AttributeError, KeyError):
-                processed_filename = os.path.join(self.__output_dir, os.path.split(r.url)[1].split("?", 1)[0])
-
-            if filename:
-                processed_filename = self.__rename(processed_filename, filename)
-
-            if check_duplicate:
-                processed_filename = check_duplicate_filename(processed_filename)
-
-            content_type = str(r.headers.get("Content-Type"))
-            if content_type[:5] == "text/":
-                r.encoding = r.apparent_encoding
-                with open(processed_filename, "w", encoding=r.encoding, newline="") as f:
-                    f.write(r.text)
-            else:
-                with open(processed_filename, "wb") as fb:
-                    shutil.copyfileobj(r.raw, fb)
+    def __link_stored(self, algorithm: str, expected_digest: Optional[str], part_filename: str, processed_filename: str) -> Optional[str]:
+        """
+        :return: the digest if the expected content is already stored and the file is linked to it
+        """
+        if self.content_store is None or expected_digest is None:
+            return None
+        stored_digest = "%s:%s" % (algorithm, expected_digest)
+        if stored_digest not in self.content_store:
+            return None
+        self.content_store.link(stored_digest, processed_filename)
+        for leftover in (part_filename, "%s.json" % part_filename):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(leftover)
+        return stored_digest
 
-            self.history.append((r.url, processed_filename, int(str(r.headers.get("Content-Length", 0))), content_type))
-        return os.path.abspath(processed_filename)
+    @classmethod
+    def __verify_cached(cls, cached: dict, algorithm: str, expected_digest: Optional[str]) -> str:
+        cached_digest = cached.get("digest") or ""
+        if expected_digest is None:
+            return cached_digest
+        if cached_digest.rpartition(":")[0] != algorithm:
+            hasher = hashlib.new(algorithm)
+            cls.__hash_file(hasher, cached["path"])
+            cached_digest = "%s:%s" % (hasher.name, hasher.hexdigest())
+        if cached_digest.rpartition(":")[2] != expected_digest:
+            raise DigestMismatchError("expected %s digest of %r to be %s, got %s" % (algorithm, cached["path"], expected_digest, cached_digest))
+        return cached_digest
 
-    async def async_start(self, url: str, filename: str = "", headers: Optional[dict] = None) -> str:
+    @staticmethod
+    def __validator(response_headers) -> Optional[str]:
+        """
+        :return: the strong ETag or else the Last-Modified of the response, usable in If-Range
+        """
+        etag = response_headers.get("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            return etag
+        return response_headers.get("Last-Modified")
+
+    @staticmethod
+    def __new_journal(url: str, response_headers) -> Optional[dict]:
+        # a partial file without a strong validator can not be resumed safely
+        etag = response_headers.get("ETag")
+        if etag is not None and etag.startswith("W/"):
+            etag = None
+        last_modified = response_headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return None
+        return {"url": url, "etag": etag, "last_modified": last_modified, "written": 0}
+
+    @staticmethod
+    def __write_journal(part_filename: str, journal: dict, fb) -> None:
+        fb.flush()
+        journal["written"] = fb.tell()
+        with open("%s.json" % part_filename, "wb") as fj:
+            fj.write(orjson.dumps(journal))
+
+    @staticmethod
+    def __read_journal(filename: str, url: str) -> Optional[dict]:
+        part_filename = "%s.part" % filename
+        try:
+            with open("%s.json" % part_filename, "rb") as fj:
+                journal = orjson.loads(fj.read())
+            size = os.path.getsize(part_filename)
+        except (OSError, orjson.JSONDecodeError):
+            return None
+        if journal.get("url") != url or journal.get("written", 0) > size:
+            return None
+        return journal
+
+    @staticmethod
+    def __resume_headers(headers: dict, journal: dict) -> dict:
+        return dict(headers, **{"Range": "bytes=%d-" % journal["written"], "If-Range": journal["etag"] or journal["last_modified"]})
+
+    @classmethod
+    def __resume_offset(cls, status: int, response_headers, journal: Optional[dict]) -> Optional[int]:
+        """
+        :return: the offset in the part file the response continues from, or None if it does not continue it
+        """
+        if journal is None:
+            return None
+        content_range = str(response_headers.get("Content-Range", ""))
+        if status == 206:
+            m = cls.CONTENT_RANGE_PATTERN.fullmatch(content_range)
+            if m is not None and int(m.group(1)) == journal["written"]:
+                return journal["written"]
+        elif status == 416 and content_range == "bytes */%d" % journal["written"]:
+            # nothing is left to send, the part file holds the whole content
+            return journal["written"]
+        return None
+
+    def __resolve_filename(self, response_headers, response_url: str, filename: str) -> str:
+        try:
+            msg = EmailMessage()
+            msg["Content-Disposition"] = response_headers["content-disposition"]
+            _raw_param = msg.get_param("filename*", header="Content-Disposition")
+            if _raw_param is None:
+                raise KeyError
+            processed_filename = os.path.join(self.__output_dir, collapse_rfc2231_value(_raw_param).strip('"'))
+        except (AttributeError, KeyError):
+            processed_filename = os.path.join(self.__output_dir, os.path.split(response_url)[1].split("?", 1)[0])
+
+        if filename:
+            processed_filename = self.__rename(processed_filename, filename)
+        return processed_filename
+
+    def __fetch_segments(self, sources: list[str], filename: str, content_length: int, segments: int, headers: dict, proxies: Optional[dict], validator: Optional[str]) -> None:
+        with open(filename, "wb") as fb:
+            fb.truncate(content_length)
+        segment_size = -(-content_length // segments)
+        ranges = [(begin, min(begin + segment_size, content_length) - 1) for begin in range(0, content_length, segment_size)]
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            # spread the segments over the sources, each segment falls back to the other sources on failure
+            futures = [executor.submit(self.__fetch_segment, sources[i % len(sources) :] + sources[: i % len(sources)], filename, begin, end, content_length, headers, proxies, validator) for i, (begin, end) in enumerate(ranges)]
+            for future in futures:
+                future.result()
+
+    def __fetch_segment(self, sources: list[str], filename: str, begin: int, end: int, content_length: int, headers: dict, proxies: Optional[dict], validator: Optional[str]) -> None:
+        range_headers = dict(headers, Range="bytes=%d-%d" % (begin, end))
+        if validator is not None:
+            # a source holding another version of the file answers with the whole of it instead
+            range_headers["If-Range"] = validator
+        for source in sources:
+            self.__pace(source)
+            try:
+                with self.session.get(source, headers=range_headers, stream=True, allow_redirects=True, proxies=proxies if proxies is not None else {}) as r:
+                    content_range = self.CONTENT_RANGE_PATTERN.fullmatch(str(r.headers.get("Content-Range", "")))
+                    if r.status_code != 206 or content_range is None or tuple(map(int, content_range.groups())) != (begin, end, content_length):
+                        continue
+                    with open(filename, "r+b") as fb:
+                        fb.seek(begin)
+                        remaining = end - begin + 1
+                        while remaining > 0:
+                            chunk = r.raw.read(min(self.chunk_size, remaining))
+                            if not chunk:
+                                break
+                            fb.write(chunk)
+                            self.__throttle(urlsplit(r.url).netloc, len(chunk))
+                            remaining -= len(chunk)
+                    if remaining == 0:
+                        return
+            except requests.RequestException:
+                continue
+        raise DownloadError("failed to fetch bytes %d-%d of %s" % (begin, end, filename))
+
+    async def async_start(
+        self,
+        url: str,
+        filename: str = "",
+        headers: Optional[dict] = None,
+        session: Optional[aiohttp.ClientSession] = None,
+        resume: bool = False,
+        digest: Optional[str] = None,
+    ) -> str:
         """
 
         similar to start() but using asyncio
@@ -206,54 +2476,249 @@ class Downloader(object):
         :param url: the URL of the target file
         :param filename: the name of the local file
         :param headers: HTTP headers to send with the request
+        :param session: a shared ClientSession to send the requests with, a new one will be created if not given,
+            the connection times are only measured if it is created with trace_configs=[Downloader.trace_config()]
+        :param resume: whether to resume the interrupted download of the same URL
+        :param digest: the expected digest, see start()
         :return: the absolute path of the downloaded local file
         """
-        if headers is None:
-            headers = {"User-Agent": self.CHROME_UA}
+        if session is None:
+            async with aiohttp.ClientSession(trust_env=True, trace_configs=[self.trace_config()]) as session:
+                return await self.__async_download(session, url, filename, headers, resume, digest)
+        return await self.__async_download(session, url, filename, headers, resume, digest)
 
-        async with aiohttp.ClientSession(trust_env=True) as session:
-            for old_url, new_urls in self.mirrors.items():
-                if old_url in url:
-                    for new_url in new_urls:
-                        test_url = url.replace(old_url, new_url)
-                        try:
-                            async with session.get(test_url, headers=headers, allow_redirects=True) as resp:
-                                code = resp.status
-                        except aiohttp.ClientError:
-                            continue
-                        if code == 200:
-                            url = test_url
-                            break
-                    break
+    async def download_many(
+        self,
+        urls: Iterable[Union[str, tuple[str, str]]],
+        concurrency: int = 10,
+        per_host: int = 0,
+        headers: Optional[dict] = None,
+        return_exceptions: bool = False,
+    ) -> AsyncIterator[tuple[str, Union[str, BaseException]]]:
+        """
+        Download a batch of files through one shared session and connector,
+        yielding the results as soon as each transfer finishes.
+
+        Example::
 
-            async with session.get(url, headers=headers, allow_redirects=True) as resp:
-                content_length = int(str(resp.headers.get("Content-Length", 0)))
-                content_type = str(resp.headers.get("Content-Type"))
-                response_url = str(resp.url)
+            async for url, path in d.download_many(urls, concurrency=16, per_host=4):
+                ...
+
+        :param urls: the URLs of the target files, or (url, filename) pairs
+        :param concurrency: the maximum number of in-flight transfers
+        :param per_host: the maximum number of in-flight transfers per host, 0 for no limit
+        :param headers: HTTP headers to send with the requests
+        :param return_exceptions: yield (url, exception) for failed transfers instead of raising
+        :return: an async iterator of (url, absolute path of the downloaded local file)
+        """
+        global_semaphore = asyncio.Semaphore(concurrency)
+        host_semaphores: defaultdict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(per_host if per_host > 0 else concurrency))
+
+        async def worker(url: str, filename: str) -> tuple[str, Union[str, BaseException]]:
+            # take the per-host slot first, so that a busy host does not hold global slots while waiting
+            async with host_semaphores[urlsplit(url).netloc], global_semaphore:
                 try:
-                    msg = EmailMessage()
-                    msg["Content-Disposition"] = resp.headers["content-disposition"]
-                    _raw_param = msg.get_param("filename*", header="Content-Disposition")
-                    if _raw_param is None:
-                        raise KeyError
-                    processed_filename = os.path.join(self.__output_dir, collapse_rfc2231_value(_raw_param).strip('"'))
-                except (AttributeError, KeyError):
-                    processed_filename = os.path.join(self.__output_dir, os.path.split(response_url)[1].split("?", 1)[0])
-
-                async with asyncio.Lock():
-                    if filename:
-                        processed_filename = self.__rename(processed_filename, filename)
-
-                    processed_filename = check_duplicate_filename(processed_filename)
-
-                    with open(processed_filename, "wb") as fb:
-                        async for chunk in resp.content.iter_chunked(1024):
-                            fb.write(chunk)
+                    return url, await self.__async_download(session, url, filename, headers)
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    return url, e
+
+        connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+        async with aiohttp.ClientSession(connector=connector, trust_env=True, trace_configs=[self.trace_config()]) as session:
+            tasks = [asyncio.create_task(worker(*((item, "") if isinstance(item, str) else item))) for item in urls]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    yield await next_done
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __async_download(self, session: aiohttp.ClientSession, url: str, filename: str, headers: Optional[dict], resume: bool = False, digest: Optional[str] = None) -> str:
+        if self.scheduler is None:
+            return await self.__async_transfer(session, url, filename, headers, resume, digest)
+        async with self.scheduler.async_slot(await self.__async_source_host(session, url, headers)):
+            return await self.__async_transfer(session, url, filename, headers, resume, digest)
+
+    async def __async_transfer(self, session: aiohttp.ClientSession, url: str, filename: str, headers: Optional[dict], resume: bool, digest: Optional[str]) -> str:
+        if headers is None:
+            headers = {"User-Agent": self.CHROME_UA}
+        requested_url = url
+        algorithm, expected_digest = self.__parse_digest(digest)
+
+        candidates = self.__mirror_candidates(url)
+        expired = self.mirror_selector.expired(candidates)
+        if expired:
+            await asyncio.gather(*(self.__async_probe_mirror(session, mirror, candidates[mirror], headers) for mirror in expired))
+        # every blocking file system call below runs in the default executor, keeping the event loop free for the network
+        cached = await asyncio.to_thread(self.cache.lookup, requested_url, filename) if self.cache is not None else None
+        resume_filename = self.__resolve_filename({}, url, filename)
+        journal = await asyncio.to_thread(self.__read_journal, resume_filename, requested_url) if resume else None
+        request_headers = DownloadCache.conditional_headers(headers, cached)
+        if journal is not None:
+            request_headers = self.__resume_headers(request_headers, journal)
+        timing = {"connect_time": 0.0, "retries": 0}
+        begin = time.perf_counter()
+        mirror, resp = await self.__async_open_with_mirrors(session, candidates, url, request_headers, timing)
+        ttfb = time.perf_counter() - begin
+        if mirror is not None:
+            url = candidates[mirror]
+        host = urlsplit(str(resp.url)).netloc
+
+        async with resp:
+            if resp.status == 304 and cached is not None:
+                cached_digest = await asyncio.to_thread(self.__verify_cached, cached, algorithm, expected_digest)
+                self.__emit(TransferMetrics("download", requested_url, str(resp.url), mirror, resp.status, timing["connect_time"], ttfb, time.perf_counter() - begin, 0, timing["retries"], True))
+                self.history.append(DownloadRecord(str(resp.url), cached["path"], cached["size"], cached["content_type"], True, cached_digest))
+                return os.path.abspath(cached["path"])
+
+            content_length = int(str(resp.headers.get("Content-Length", 0)))
+            content_type = str(resp.headers.get("Content-Type"))
+            response_url = str(resp.url)
+            processed_filename = self.__resolve_filename(resp.headers, response_url, filename)
+
+            allocator = FilenameAllocator.for_directory(os.path.dirname(processed_filename)) if journal is None else None
+            if allocator is not None:
+                processed_filename = await asyncio.to_thread(allocator.reserve, processed_filename)
+            part_filename = "%s.part" % (resume_filename if resume else processed_filename)
 
-        async with asyncio.Lock():
-            self.history.append((response_url, processed_filename, content_length, content_type))
+            try:
+                offset = self.__resume_offset(resp.status, resp.headers, journal)
+                if offset is not None:
+                    content_length = offset + (content_length if resp.status == 206 else 0)
+                hasher = hashlib.new(algorithm)
+                stored_digest = await asyncio.to_thread(self.__link_stored, algorithm, expected_digest, part_filename, processed_filename)
+                if stored_digest is not None:
+                    resp.release()
+                elif offset is not None and resp.status == 416:
+                    resp.release()
+                    fb = await asyncio.to_thread(self.__open_part, part_filename, offset, hasher)
+                    await asyncio.to_thread(fb.close)
+                elif offset is not None:
+                    await self.__async_write_stream(resp, part_filename, offset, self.__new_journal(requested_url, resp.headers), hasher, host)
+                elif resp.status in (206, 416):
+                    resp.release()
+                    await self.__async_pace(url)
+                    async with session.get(url, headers=headers, allow_redirects=True) as full_resp:
+                        full_resp.raise_for_status()
+                        await self.__async_write_stream(full_resp, part_filename, 0, self.__new_journal(requested_url, full_resp.headers), hasher, host)
+                else:
+                    await self.__async_write_stream(resp, part_filename, 0, self.__new_journal(requested_url, resp.headers) if resume else None, hasher, host)
+                if stored_digest is None:
+                    actual_digest = await asyncio.to_thread(self.__commit_part, part_filename, processed_filename, hasher, expected_digest)
+                else:
+                    actual_digest = stored_digest
+            except BaseException:
+                # a single unlink, done right away so that it also happens on cancellation
+                if allocator is not None:
+                    allocator.release(processed_filename)
+                raise
+            elapsed = time.perf_counter() - begin
+            size = await asyncio.to_thread(os.path.getsize, processed_filename) if stored_digest is None else 0
+            if mirror is not None and stored_digest is None:
+                self.mirror_selector.record_transfer(mirror, size, elapsed)
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.store, requested_url, filename, processed_filename, resp.headers, content_type, actual_digest)
+            self.__emit(TransferMetrics("download", requested_url, response_url, mirror, resp.status, timing["connect_time"], ttfb, elapsed, size, timing["retries"], stored_digest is not None))
+
+        self.history.append(DownloadRecord(response_url, processed_filename, content_length, content_type, stored_digest is not None, actual_digest))
         return os.path.abspath(processed_filename)
 
+    async def __async_probe_mirror(self, session: aiohttp.ClientSession, mirror: str, test_url: str, headers: dict) -> None:
+        timeout = aiohttp.ClientTimeout(total=self.PROBE_TIMEOUT)
+        await self.__async_pace(test_url)
+        timing = {"connect_time": 0.0, "retries": 0}
+        begin = time.perf_counter()
+        try:
+            async with session.head(test_url, headers=headers, allow_redirects=True, timeout=timeout, trace_request_ctx=timing) as resp:
+                code = resp.status
+            if code in (405, 501):
+                await self.__async_pace(test_url)
+                async with session.get(test_url, headers=dict(headers, Range="bytes=0-0"), allow_redirects=True, timeout=timeout, trace_request_ctx=timing) as resp:
+                    code = resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.mirror_selector.update(mirror, False)
+            self.__emit(TransferMetrics("probe", test_url, test_url, mirror, 0, timing["connect_time"], 0.0, time.perf_counter() - begin, 0, timing["retries"], False))
+            return
+        latency = time.perf_counter() - begin
+        self.mirror_selector.update(mirror, code in (200, 206), latency)
+        self.__emit(TransferMetrics("probe", test_url, test_url, mirror, code, timing["connect_time"], latency, latency, 0, timing["retries"], False))
+
+    async def __async_open_with_mirrors(self, session: aiohttp.ClientSession, candidates: dict[str, str], url: str, headers: dict, timing: dict) -> tuple[Optional[str], aiohttp.ClientResponse]:
+        for mirror in self.mirror_selector.rank(candidates):
+            await self.__async_pace(candidates[mirror])
+            try:
+                resp = await session.get(candidates[mirror], headers=headers, allow_redirects=True, trace_request_ctx=timing)
+            except aiohttp.ClientError:
+                self.mirror_selector.update(mirror, False)
+                timing["retries"] += 1
+                continue
+            if resp.status in (200, 206, 304, 416):
+                return mirror, resp
+            resp.release()
+            timing["retries"] += 1
+            if resp.status >= 500:
+                self.mirror_selector.update(mirror, False)
+        await self.__async_pace(url)
+        return None, await session.get(url, headers=headers, allow_redirects=True, trace_request_ctx=timing)
+
+    async def __async_write_stream(self, resp: aiohttp.ClientResponse, part_filename: str, offset: int, journal: Optional[dict], hasher, host: str) -> None:
+        loop = asyncio.get_running_loop()
+        fb = await asyncio.to_thread(self.__open_part, part_filename, offset, hasher)
+        try:
+            # one chunk is written and hashed in the executor while the next one is received
+            pending: Optional[asyncio.Future] = None
+            unjournaled = 0
+            try:
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    if pending is not None:
+                        await pending
+                    pending = loop.run_in_executor(None, self.__write_chunk, fb, hasher, chunk)
+                    await self.__async_throttle(host, len(chunk))
+                    unjournaled += len(chunk)
+                    if journal is not None and unjournaled >= self.JOURNAL_INTERVAL:
+                        await pending
+                        pending = None
+                        await asyncio.to_thread(self.__write_journal, part_filename, journal, fb)
+                        unjournaled = 0
+            finally:
+                if pending is not None:
+                    await pending
+                if journal is not None:
+                    await asyncio.to_thread(self.__write_journal, part_filename, journal, fb)
+        finally:
+            await asyncio.to_thread(fb.close)
+
+    def __pace(self, url: str) -> None:
+        if self.scheduler is not None:
+            delay = self.scheduler.request_delay(urlsplit(url).netloc)
+            if delay > 0:
+                time.sleep(delay)
+
+    def __throttle(self, host: str, size: int) -> None:
+        if self.scheduler is not None:
+            delay = self.scheduler.transfer_delay(host, size)
+            if delay > 0:
+                time.sleep(delay)
+
+    async def __async_pace(self, url: str) -> None:
+        if self.scheduler is not None:
+            delay = self.scheduler.request_delay(urlsplit(url).netloc)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def __async_throttle(self, host: str, size: int) -> None:
+        if self.scheduler is not None:
+            delay = self.scheduler.transfer_delay(host, size)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def __write_chunk(fb: BinaryIO, hasher, chunk: bytes) -> None:
+        fb.write(chunk)
+        hasher.update(chunk)
+
     def __rename(self, old_filename: str, new_filename: str) -> str:
         renamed_filename = (
             os.path.join(
@@ -269,6 +2734,10 @@ class Downloader(object):
 class FolderMonitor(object):
     """
     A tool for monitoring a folder and executing a function when files change.
+
+    The events of a path are debounced: the handlers run once the path has been quiet for debounce_time.
+    A single scheduler thread keeps the pending paths in a heap of deadlines, one entry per path,
+    so an event storm neither creates threads nor grows the memory beyond the number of paths.
     """
 
     _thread_pool = ThreadPoolExecutor(max_workers=4)
@@ -285,8 +2754,12 @@ class FolderMonitor(object):
         self._event_handler = self._create_event_handler()
         self._running = False
 
-        self._debounce_timers = {}
-        self._debounce_lock = Lock()
+        # {src_path: (deadline, latest_event)}, and a heap of (deadline, src_path) with one entry per pending path,
+        # whose deadline may be earlier than the one of the path when later events postponed it
+        self._pending = {}
+        self._deadlines = []
+        self._debounce_cond = Condition()
+        self._scheduler = None
 
         # Event registry
         # {('event_type', is_directory_tuple_key): [func1, func2, ...]}
@@ -295,7 +2768,7 @@ class FolderMonitor(object):
 
     def on_event(
         self,
-        event_type: Literal["created", "deleted", "modified", "moved"],
+        event_type: Literal["created", "deleted", "modified", "moved", "opened", "closed", "closed_no_write"],
         is_directory: Optional[bool] = None,
     ):
         """Event registry decorator.
@@ -323,24 +2796,41 @@ class FolderMonitor(object):
 
             def on_any_event(self, event):
                 # 可以在这里添加一些全局过滤逻辑
-                self.monitor._thread_pool.submit(self.monitor._handle_event_debounced, event)
+                self.monitor._handle_event_debounced(event)
 
         return Handler(self)
 
     def _handle_event_debounced(self, event):
         event_key = event.src_path
-        with self._debounce_lock:
-            if event_key in self._debounce_timers:
-                self._debounce_timers[event_key].cancel()
-            timer = Timer(self.debounce_time, self._execute_handlers, args=[event])
-            self._debounce_timers[event_key] = timer
-            timer.start()
+        deadline = time.monotonic() + self.debounce_time
+        with self._debounce_cond:
+            if event_key not in self._pending:
+                heapq.heappush(self._deadlines, (deadline, event_key))
+                if self._deadlines[0][1] == event_key:
+                    self._debounce_cond.notify()
+            # an already pending path keeps its heap entry, the scheduler postpones it when it comes due
+            self._pending[event_key] = (deadline, event)
+
+    def _run_scheduler(self):
+        with self._debounce_cond:
+            while self._running:
+                if not self._deadlines:
+                    self._debounce_cond.wait()
+                    continue
+                deadline, event_key = self._deadlines[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._debounce_cond.wait(delay)
+                    continue
+                pending_deadline, event = self._pending[event_key]
+                if pending_deadline > deadline:
+                    heapq.heapreplace(self._deadlines, (pending_deadline, event_key))
+                    continue
+                heapq.heappop(self._deadlines)
+                del self._pending[event_key]
+                self._thread_pool.submit(self._execute_handlers, event)
 
     def _execute_handlers(self, event):
-        with self._debounce_lock:
-            if event.src_path in self._debounce_timers:
-                del self._debounce_timers[event.src_path]
-
         handler_key = (event.event_type, event.is_directory)
 
         # 查找并执行所有匹配的处理器
@@ -369,6 +2859,8 @@ class FolderMonitor(object):
         self._observer.schedule(self._event_handler, self.path, recursive=self.recursive)
         self._observer.start()
         self._running = True
+        self._scheduler = Thread(target=self._run_scheduler, name="FolderMonitor-debounce", daemon=True)
+        self._scheduler.start()
 
     def stop(self):
         if not self._running:
@@ -378,12 +2870,14 @@ class FolderMonitor(object):
         self._observer.stop()
         self._observer.join()
 
-        # 取消所有待处理的防抖 Timer
-        with self._debounce_lock:
-            for timer in self._debounce_timers.values():
-                timer.cancel()
-            self._debounce_timers.clear()
-        self._running = False
+        # 丢弃所有待处理的防抖事件
+        with self._debounce_cond:
+            self._pending.clear()
+            self._deadlines.clear()
+            self._running = False
+            self._debounce_cond.notify()
+        self._scheduler.join()
+        self._scheduler = None
 
     @classmethod
     def shutdown_thread_pool(cls, wait=True):
@@ -1,4 +1,7 @@
-from clayutil.futil import check_duplicate_filename
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from clayutil.futil import FilenameAllocator, check_duplicate_filename
 
 
 def test():
@@ -7,3 +10,44 @@ def test():
     assert check_duplicate_filename("./test (1) (1).txt") == "./test (1) (4).txt"
     assert check_duplicate_filename("./test (999).txt") == "./test (1000).txt"
     assert check_duplicate_filename("./test_5.test", r"_{n}") == "./test_6.test"
+
+
+def test_allocator(tmp_path):
+    for filename in ["a.txt", "a (1).txt", "a (2).txt"]:
+        (tmp_path / filename).touch()
+    allocator = FilenameAllocator.for_directory(str(tmp_path))
+    assert FilenameAllocator.for_directory(str(tmp_path)) is allocator
+    # created after the directory was indexed
+    (tmp_path / "a (3).txt").touch()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        reserved = list(executor.map(allocator.reserve, [os.path.join(tmp_path, "a.txt")] * 50))
+    assert sorted(reserved) == sorted(os.path.join(tmp_path, "a (%d).txt" % n) for n in range(4, 54))
+    assert all(os.path.exists(filename) for filename in reserved)
+    allocator.release(os.path.join(tmp_path, "a (4).txt"))
+    assert not os.path.exists(os.path.join(tmp_path, "a (4).txt"))
+    assert allocator.reserve(os.path.join(tmp_path, "a.txt")) == os.path.join(tmp_path, "a (4).txt")
+
+    # deleted by someone else, the name is handed out again
+    os.remove(os.path.join(tmp_path, "a (4).txt"))
+    os.remove(os.path.join(tmp_path, "a.txt"))
+    assert allocator.reserve(os.path.join(tmp_path, "a.txt")) == os.path.join(tmp_path, "a.txt")
+
+
+def test_allocator_listing(tmp_path, monkeypatch):
+    for i in range(1000):
+        (tmp_path / ("old%d.bin" % i)).touch()
+    listings = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, "listdir", lambda path=".": listings.append(path) or listdir(path))
+    allocator = FilenameAllocator(str(tmp_path))
+    # reserved, written to a part file and renamed into place, like Downloader does
+    for i in range(200):
+        filename = allocator.reserve(os.path.join(tmp_path, "new%d.bin" % i))
+        with open("%s.part" % filename, "wb") as fb:
+            fb.write(b"data")
+        os.replace("%s.part" % filename, filename)
+    assert listings == []
+
+    # only a collision lists the directory
+    assert allocator.reserve(os.path.join(tmp_path, "new0.bin")) == os.path.join(tmp_path, "new0 (1).bin")
+    assert len(listings) == 1
@@ -6,7 +6,6 @@ import time
 import pytest
 
 from clayutil.futil import Downloader
-from clayutil.sutil import md5sum
 
 
 @pytest.fixture
@@ -43,11 +42,10 @@ def test(clean_tmp_files):
     print(downloaded)
     assert downloaded[1] == os.path.join("./", "Ventoy_v1.0.97 (1).sha256")
 
-    d.start("https://osu.ppy.sh/osu/3477131")
+    # 边下载边验证 md5
+    d.start("https://osu.ppy.sh/osu/3477131", digest="md5:BD54DB0CFE5C44EF576D9DEC7D5C0F9F")
     downloaded = d.history.pop()
-    # 验证 md5
-    with open(downloaded[1], "rb") as fi_b:
-        assert md5sum(fi_b.read()) == "BD54DB0CFE5C44EF576D9DEC7D5C0F9F".lower()
+    assert downloaded.digest == "md5:%s" % "BD54DB0CFE5C44EF576D9DEC7D5C0F9F".lower()
 
 
 async def async_test_main():
@@ -59,7 +57,7 @@ async def async_test_main():
     async with asyncio.TaskGroup() as tg:
         tg.create_task(d.async_start("https://repo.archlinuxcn.org/lastupdate", "ArchLinuxCN_lastupdate"))
         tg.create_task(d.async_start("https://repo.archlinuxcn.org/lastupdate", "ArchLinuxCN_lastupdate"))
-        tg.create_task(d.async_start("https://osu.ppy.sh/osu/3477131", "TRUE - Storyteller (IOException) [Expert].osu"))
+        tg.create_task(d.async_start("https://osu.ppy.sh/osu/3477131", "TRUE - Storyteller (IOException) [Expert].osu", digest="md5:BD54DB0CFE5C44EF576D9DEC7D5C0F9F"))
     return d.history
 
 
@@ -72,5 +70,4 @@ def test_async(clean_tmp_files):
     # 选中 filename
     for filename in history:
         if "TRUE - Storyteller (IOException) [Expert]" in filename[1]:
-            with open(filename[1], "rb") as fi_b:
-                assert md5sum(fi_b.read()) == "BD54DB0CFE5C44EF576D9DEC7D5C0F9F".lower()
+            assert filename.digest == "md5:%s" % "BD54DB0CFE5C44EF576D9DEC7D5C0F9F".lower()
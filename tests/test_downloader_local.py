@@ -0,0 +1,502 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import pytest
+
+from clayutil.futil import ByteCache, ContentStore, DigestMismatchError, DownloadCache, DownloadRecord, Downloader, Histogram, RingHistory, SQLiteHistory, TokenBucket, TransferScheduler
+
+PAYLOAD = os.urandom(4096)
+ETAG = '"v1"'
+# another version of the file, served by /other/
+OTHER_PAYLOAD = os.urandom(4096)
+OTHER_ETAG = '"v2"'
+# served by /big/
+BIG_PAYLOAD = os.urandom(512 * 1024)
+TEXT = ("ascii only line\r\n" * 10000 + "中文测试\r\nmixed 测试 line\n" * 10000).encode("utf-8")
+# served by /text/latin1/, the non-ASCII bytes only come after a long ASCII prefix, some of them undefined in cp1252
+LATIN1_TEXT = b"ascii only line\n" * 20000 + b"caf\xe9 na\xefve\r\n\x81\x8d\x8f\x90\x9d\n"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_HEAD(self):
+        self.server.requests.append("HEAD %s" % self.path)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.ranges.append(self.headers.get("Range"))
+        if self.path.startswith("/m1/missing"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path.startswith("/flaky/") and self.server.requests.count(self.path) < 2:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.end_headers()
+            return
+        if self.path.startswith("/text/"):
+            text = LATIN1_TEXT if self.path.startswith("/text/latin1/") else TEXT
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(text)))
+            self.end_headers()
+            self.wfile.write(text)
+            return
+        payload, etag = (OTHER_PAYLOAD, OTHER_ETAG) if self.path.startswith("/other/") else (BIG_PAYLOAD, ETAG) if self.path.startswith("/big/") else (PAYLOAD, ETAG)
+        body = payload
+        m = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if m and not self.path.startswith("/norange/") and self.headers.get("If-Range", etag) == etag and int(m.group(1)) >= len(payload):
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % len(payload))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if m and not self.path.startswith("/norange/") and self.headers.get("If-Range", etag) == etag:
+            begin, end = int(m.group(1)), int(m.group(2) or len(payload) - 1)
+            body = payload[begin : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (begin, end, len(payload)))
+        else:
+            self.send_response(200)
+        if not self.path.startswith("/norange/"):
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    httpd.connections = 0
+    httpd.requests = []
+    httpd.ranges = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def base_url(httpd) -> str:
+    return "http://127.0.0.1:%d" % httpd.server_address[1]
+
+
+def test_keep_alive(server, tmp_path):
+    with Downloader(str(tmp_path)) as d:
+        for i in range(5):
+            path = d.start("%s/file%d.bin" % (base_url(server), i))
+            with open(path, "rb") as fi_b:
+                assert fi_b.read() == PAYLOAD
+    assert server.connections == 1
+
+
+def test_retry(server, tmp_path):
+    with Downloader(str(tmp_path), backoff_factor=0) as d:
+        path = d.start("%s/flaky/file.bin" % base_url(server))
+    assert os.path.getsize(path) == len(PAYLOAD)
+    assert server.requests.count("/flaky/file.bin") == 2
+
+
+async def download_many_main(url: str, output_dir: str):
+    d = Downloader(output_dir)
+    results = []
+    async for item in d.download_many(["%s/file%d.bin" % (url, i) for i in range(20)] + [("%s/named.bin" % url, "renamed")], concurrency=4, per_host=2):
+        results.append(item)
+    return d.history, results
+
+
+def test_download_many(server, tmp_path):
+    history, results = asyncio.run(download_many_main(base_url(server), str(tmp_path)))
+    assert len(results) == len(history) == 21
+    for _url, path in results:
+        assert os.path.getsize(path) == len(PAYLOAD)
+    assert os.path.exists(os.path.join(tmp_path, "renamed.bin"))
+    assert server.connections <= 2
+
+
+def test_segments(server, tmp_path):
+    url = base_url(server)
+    with Downloader(str(tmp_path), {"%s/mirrored/" % url: ["http://null/", "%s/m1/" % url, "%s/m2/" % url]}) as d:
+        d.MIN_SEGMENT_SIZE = 512
+        path = d.start("%s/mirrored/seg.bin" % url, segments=4)
+        with open(path, "rb") as fi_b:
+            assert fi_b.read() == PAYLOAD
+        ranged = [p for p in server.requests if p.endswith("/seg.bin")]
+        assert {"/m1/seg.bin", "/m2/seg.bin"} <= set(ranged)
+
+        path = d.start("%s/norange/seg.bin" % url, "fallback.bin", segments=4)
+        with open(path, "rb") as fi_b:
+            assert fi_b.read() == PAYLOAD
+
+    # a mirror holding another version of the file does not get its bytes mixed in
+    with Downloader(str(tmp_path), {"%s/mirrored/" % url: ["%s/m1/" % url, "%s/other/" % url]}) as d:
+        d.MIN_SEGMENT_SIZE = 512
+        path = d.start("%s/mirrored/mixed.bin" % url, segments=4)
+        with open(path, "rb") as fi_b:
+            assert fi_b.read() in (PAYLOAD, OTHER_PAYLOAD)
+        assert {"/m1/mixed.bin", "/other/mixed.bin"} <= set(server.requests)
+
+
+def interrupt(filename: str, url: str, etag: str, written: int = 1000) -> None:
+    with open("%s.part" % filename, "wb") as fb:
+        fb.write(PAYLOAD[:written])
+    with open("%s.part.json" % filename, "w") as fj:
+        json.dump({"url": url, "etag": etag, "last_modified": None, "written": written}, fj)
+
+
+def test_resume(server, tmp_path):
+    url = "%s/resume.bin" % base_url(server)
+    with Downloader(str(tmp_path)) as d:
+        interrupt(os.path.join(tmp_path, "resume.bin"), url, ETAG)
+        path = d.start(url, resume=True)
+        # the first request already continues the part file
+        assert server.requests.count("/resume.bin") == 1 and server.ranges[-1] == "bytes=1000-"
+        with open(path, "rb") as fi_b:
+            assert fi_b.read() == PAYLOAD
+        assert not os.path.exists("%s.part" % path) and not os.path.exists("%s.part.json" % path)
+
+        # interrupted after the last write, the server has nothing left to send
+        interrupt(path, url, ETAG, len(PAYLOAD))
+        path = d.start(url, resume=True, digest=hashlib.sha256(PAYLOAD).hexdigest())
+        with open(path, "rb") as fi_b:
+            assert fi_b.read() == PAYLOAD
+        assert not os.path.exists("%s.part" % path)
+
+        # the remote file has changed, If-Range makes the server send the whole file
+        interrupt(path, url, '"v0"')
+        path = d.start(url, resume=True)
+        with open(path, "rb") as fi_b:
+            assert fi_b.read() == PAYLOAD
+
+    interrupt(path, url, ETAG)
+    requests = len(server.requests)
+    path = asyncio.run(Downloader(str(tmp_path)).async_start(url, resume=True))
+    assert len(server.requests) == requests + 1 and server.ranges[-1] == "bytes=1000-"
+    with open(path, "rb") as fi_b:
+        assert fi_b.read() == PAYLOAD
+
+    interrupt(path, url, ETAG, len(PAYLOAD))
+    path = asyncio.run(Downloader(str(tmp_path)).async_start(url, resume=True))
+    with open(path, "rb") as fi_b:
+        assert fi_b.read() == PAYLOAD
+
+
+def test_mirror_health(server, tmp_path):
+    url = base_url(server)
+    with Downloader(str(tmp_path), {"%s/orig/" % url: ["http://null/", "%s/m1/" % url]}) as d:
+        for i in range(3):
+            d.start("%s/orig/file%d.bin" % (url, i))
+        assert [p for p in server.requests if p.startswith("HEAD")] == ["HEAD /m1/file0.bin"]
+        assert [p for p in server.requests if not p.startswith("HEAD")] == ["/m1/file0.bin", "/m1/file1.bin", "/m1/file2.bin"]
+        table = d.mirror_selector.table()
+        assert not table["http://null/"][0] and table["%s/m1/" % url][0]
+
+        # the mirror does not have this file
+        path = d.start("%s/orig/missing.bin" % url)
+        assert os.path.getsize(path) == len(PAYLOAD)
+        assert server.requests[-1] == "/orig/missing.bin"
+        assert d.mirror_selector.table()["%s/m1/" % url][0]
+
+
+def test_cache(server, tmp_path):
+    url = "%s/cached.bin" % base_url(server)
+    cache_index = os.path.join(tmp_path, "cache.sqlite3")
+    with Downloader(str(tmp_path), cache_index=cache_index) as d:
+        path = d.start(url)
+        assert not d.history[-1].from_cache
+        assert d.start(url) == path
+        assert d.history[-1].from_cache
+
+    path = asyncio.run(Downloader(str(tmp_path), cache_index=cache_index).async_start(url))
+    assert path == os.path.join(tmp_path, "cached.bin")
+    assert server.requests.count("/cached.bin") == 3
+
+    os.remove(path)
+    with Downloader(str(tmp_path), cache_index=cache_index) as d:
+        d.start(url)
+        assert not d.history[-1].from_cache
+        assert os.path.getsize(path) == len(PAYLOAD)
+        # another filename is another download
+        d.start(url, "other.bin")
+        assert not d.history[-1].from_cache
+
+    # every entry is a row of its own, stored from many threads at once
+    cache = DownloadCache(os.path.join(tmp_path, "many.sqlite3"))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: cache.store("%s/%d" % (url, i), "", path, {"ETag": '"%d"' % i}, "application/octet-stream"), range(1000)))
+    cache.close()
+    cache = DownloadCache(os.path.join(tmp_path, "many.sqlite3"))
+    assert cache.lookup("%s/999" % url, "")["etag"] == '"999"'
+    cache.store("%s/999" % url, "", path, {}, "application/octet-stream")
+    assert cache.lookup("%s/999" % url, "") is None and cache.lookup("%s/998" % url, "")["size"] == len(PAYLOAD)
+    cache.close()
+
+
+def test_digest(server, tmp_path):
+    url = "%s/digest.bin" % base_url(server)
+    sha256 = hashlib.sha256(PAYLOAD).hexdigest()
+    with Downloader(str(tmp_path)) as d:
+        d.start(url, digest=sha256)
+        assert d.history[-1].digest == "sha256:%s" % sha256
+        d.start(url, "md5.bin", digest="md5:%s" % hashlib.md5(PAYLOAD).hexdigest().upper())
+        assert d.history[-1].digest == "md5:%s" % hashlib.md5(PAYLOAD).hexdigest()
+
+        with open(os.path.join(tmp_path, "digest.bin"), "wb") as fo:
+            fo.write(b"previous")
+        with pytest.raises(DigestMismatchError):
+            d.start(url, digest="0" * 64)
+        with open(os.path.join(tmp_path, "digest.bin"), "rb") as fi_b:
+            assert fi_b.read() == b"previous"
+        assert not os.path.exists(os.path.join(tmp_path, "digest.bin.part"))
+
+        # the resumed bytes are hashed too
+        interrupt(os.path.join(tmp_path, "digest.bin"), url, ETAG)
+        d.start(url, resume=True, digest=sha256)
+
+    with pytest.raises(DigestMismatchError):
+        asyncio.run(Downloader(str(tmp_path)).async_start(url, "async.bin", digest="0" * 64))
+    assert not os.path.exists(os.path.join(tmp_path, "async.bin"))
+
+
+def test_content_store(server, tmp_path):
+    sha256 = hashlib.sha256(PAYLOAD).hexdigest()
+    store = ContentStore(str(tmp_path / "store"))
+    with Downloader(str(tmp_path / "out"), content_store=store) as d:
+        a = d.start("%s/a.bin" % base_url(server))
+        b = d.start("%s/b.bin" % base_url(server))
+        assert "sha256:%s" % sha256 in store
+        assert os.listdir(os.path.dirname(store.blob_path("sha256:%s" % sha256))) == [sha256]
+        assert os.stat(a).st_ino == os.stat(b).st_ino == os.stat(store.blob_path("sha256:%s" % sha256)).st_ino
+
+        # the content is known, so only the name is taken from the response
+        c = d.start("%s/c.bin" % base_url(server), check_duplicate=True, digest=sha256)
+        assert d.history[-1].from_cache
+        assert os.stat(c).st_ino == os.stat(a).st_ino
+        c = asyncio.run(d.async_start("%s/c.bin" % base_url(server), digest=sha256))
+        assert os.path.basename(c) == "c (1).bin"
+        assert d.history[-1] == DownloadRecord("%s/c.bin" % base_url(server), c, len(PAYLOAD), "application/octet-stream", True, "sha256:%s" % sha256)
+        assert not [name for name in os.listdir(tmp_path / "out") if name.endswith((".part", ".link"))]
+
+
+def test_scheduler(server, tmp_path):
+    bucket = TokenBucket(100, 1)
+    assert bucket.reserve() == 0.0
+    assert 0.0 < bucket.reserve() <= 0.01
+
+    async def fair_order() -> list[str]:
+        scheduler = TransferScheduler(max_active=1)
+        order = []
+
+        async def transfer(host: str) -> None:
+            async with scheduler.async_slot(host):
+                order.append(host)
+                await asyncio.sleep(0)
+
+        await asyncio.gather(*(transfer(host) for host in ["a.example"] * 4 + ["b.example"] * 2))
+        return order
+
+    # the second host does not wait for the queue of the first one
+    assert asyncio.run(fair_order()) == ["a.example", "a.example", "b.example", "a.example", "b.example", "a.example"]
+
+    scheduler = TransferScheduler(requests_per_second=100, total_bytes_per_second=len(PAYLOAD))
+    with Downloader(str(tmp_path), chunk_size=1024, scheduler=scheduler) as d:
+        begin = time.monotonic()
+        d.start("%s/paced1.bin" % base_url(server))
+        asyncio.run(d.async_start("%s/paced2.bin" % base_url(server)))
+        # the first file drains the bucket, the second one waits for it to refill
+        assert time.monotonic() - begin >= 0.8
+
+    # the slot and the bytes are charged to the mirror serving the file, not to the host of the URL
+    scheduler = TransferScheduler()
+    slots, charged = [], set()
+    acquire, async_acquire, transfer_delay = scheduler.acquire, scheduler.async_acquire, scheduler.transfer_delay
+    scheduler.acquire = lambda host: (slots.append(host), acquire(host))[1]
+    scheduler.async_acquire = lambda host: (slots.append(host), async_acquire(host))[1]
+    scheduler.transfer_delay = lambda host, size: (charged.add(host), transfer_delay(host, size))[1]
+    mirror_host = "localhost:%d" % server.server_address[1]
+    with Downloader(str(tmp_path), {"%s/mirrored/" % base_url(server): ["http://%s/m1/" % mirror_host]}, scheduler=scheduler) as d:
+        d.start("%s/mirrored/slot1.bin" % base_url(server))
+        asyncio.run(d.async_start("%s/mirrored/slot2.bin" % base_url(server)))
+        d.fetch_bytes("%s/mirrored/slot3.bin" % base_url(server))
+    assert slots == [mirror_host] * 3 and charged == {mirror_host}
+
+
+def test_metrics(server, tmp_path):
+    histogram = Histogram()
+    for value in [0.0] + [float(i) for i in range(1, 101)]:
+        histogram.add(value)
+    assert histogram.percentile(0) == 0.0 and histogram.percentile(100) == 100.0
+    assert 50 <= histogram.percentile(50) <= 50 * Histogram.GROWTH
+
+    url = base_url(server)
+    with Downloader(str(tmp_path), {"%s/orig/" % url: ["%s/m1/" % url]}, backoff_factor=0) as d:
+        observed = []
+        d.on_metrics(observed.append)
+        d.start("%s/orig/file.bin" % url)
+        d.start("%s/orig/missing.bin" % url)
+        d.start("%s/flaky/file.bin" % url)
+        asyncio.run(d.async_start("%s/orig/async.bin" % url))
+
+    probe, mirrored, missing, flaky, async_mirrored = observed
+    assert probe.kind == "probe" and probe.status == 200 and probe.connect_time > 0
+    assert mirrored.mirror == "%s/m1/" % url and mirrored.size == len(PAYLOAD)
+    # the probe connection is not the one of the download
+    assert mirrored.connect_time > 0 and 0 < mirrored.ttfb <= mirrored.elapsed
+    assert missing.mirror is None and missing.retries == 1
+    assert flaky.retries == 1
+    assert async_mirrored.mirror == "%s/m1/" % url and async_mirrored.connect_time > 0
+
+    assert d.metrics.counters() == {"count": 4, "failures": 0, "retries": 2, "cache_hits": 0}
+    assert d.metrics.counters("probe") == {"count": 1, "failures": 0, "retries": 0, "cache_hits": 0}
+    assert d.metrics.mirror_wins() == {"%s/m1/" % url: 2}
+    assert d.metrics.hosts() == [urlsplit(url).netloc]
+    assert d.metrics.histogram("size").count == 4
+    assert d.metrics.summary()["throughput"]["max"] > 0
+
+
+def test_fetch(server, tmp_path):
+    url = base_url(server)
+    with Downloader(str(tmp_path), chunk_size=1024, byte_cache=ByteCache(max_size=len(PAYLOAD) * 2, ttl=60)) as d:
+        assert d.fetch_bytes("%s/a.bin" % url) == PAYLOAD
+        assert b"".join(d.fetch_stream("%s/a.bin" % url)) == PAYLOAD
+        assert d.fetch_bytes("%s/a.bin" % url) is d.fetch_bytes("%s/a.bin" % url)
+        assert server.requests.count("/a.bin") == 1
+
+        # the least recently used content is evicted
+        d.fetch_bytes("%s/b.bin" % url)
+        d.fetch_bytes("%s/a.bin" % url)
+        d.fetch_bytes("%s/c.bin" % url)
+        assert len(d.byte_cache) == 2 and d.byte_cache.size == len(PAYLOAD) * 2
+        d.fetch_bytes("%s/b.bin" % url)
+        assert server.requests.count("/a.bin") == 1 and server.requests.count("/b.bin") == 2
+
+        # an abandoned stream is not cached
+        next(d.fetch_stream("%s/d.bin" % url))
+        assert d.byte_cache.get("%s/d.bin" % url) is None
+
+        d.byte_cache.ttl = 0
+        d.fetch_bytes("%s/e.bin" % url)
+        d.fetch_bytes("%s/e.bin" % url)
+        assert server.requests.count("/e.bin") == 2
+    assert os.listdir(tmp_path) == []
+
+
+def test_text(server, tmp_path):
+    with Downloader(str(tmp_path)) as d:
+        d.MIN_SEGMENT_SIZE = 512
+        path = d.start("%s/text/file.txt" % base_url(server), digest=hashlib.sha256(TEXT).hexdigest())
+        with open(path, "rb") as fi_b:
+            assert fi_b.read() == TEXT
+
+        # the bytes after the ASCII prefix are kept as they are
+        digest = hashlib.sha256(LATIN1_TEXT).hexdigest()
+        path = d.start("%s/text/latin1/file.txt" % base_url(server), digest=digest)
+        with open(path, "rb") as fi_b:
+            assert fi_b.read() == LATIN1_TEXT
+    path = asyncio.run(Downloader(str(tmp_path)).async_start("%s/text/latin1/async.txt" % base_url(server), digest=digest))
+    with open(path, "rb") as fi_b:
+        assert fi_b.read() == LATIN1_TEXT
+
+    # the recorded digest and the stored blob describe the bytes in the file
+    store = ContentStore(str(tmp_path / "store"))
+    with Downloader(str(tmp_path / "out"), content_store=store) as d:
+        path = d.start("%s/text/latin1/stored.txt" % base_url(server))
+        with open(path, "rb") as fi_b:
+            actual_digest = "sha256:%s" % hashlib.sha256(fi_b.read()).hexdigest()
+        assert d.history[-1].digest == actual_digest == "sha256:%s" % digest
+        assert os.stat(path).st_ino == os.stat(store.blob_path(actual_digest)).st_ino
+
+
+def test_history(server, tmp_path):
+    ring = RingHistory(8)
+    assert not hasattr(ring, "__dict__")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda i: ring.append(DownloadRecord("url%d" % i, "file%d" % i, i, "")), range(100)))
+    assert len(ring) == 8
+    ring.append(DownloadRecord("last", "last", 1, "", True, "sha256:0"))
+    assert ring[-1] == ring.pop() == DownloadRecord("last", "last", 1, "", True, "sha256:0")
+    # the records still unpack as (url, filename, content_length, content_type)
+    ring.append(DownloadRecord("last", "last", 1, "text/plain", True, "sha256:0"))
+    url, filename, content_length, content_type = ring.pop()
+    assert (url, filename, content_length, content_type) == ("last", "last", 1, "text/plain")
+    assert len(list(ring)) == 7
+
+    sqlite_history = SQLiteHistory(os.path.join(tmp_path, "history.db"))
+    with Downloader(str(tmp_path), history=sqlite_history) as d:
+        path = d.start("%s/history.bin" % base_url(server))
+    asyncio.run(Downloader(str(tmp_path), history=sqlite_history).async_start("%s/history.bin" % base_url(server)))
+    sqlite_history.close()
+
+    sqlite_history = SQLiteHistory(os.path.join(tmp_path, "history.db"))
+    assert len(sqlite_history) == 2
+    assert [record.filename for record in sqlite_history.find_by_url("%s/history.bin" % base_url(server))] == [path, os.path.join(tmp_path, "history (1).bin")]
+    assert sqlite_history.find_by_filename(path)[0].digest == "sha256:%s" % hashlib.sha256(PAYLOAD).hexdigest()
+    assert sqlite_history[0][:3] == ("%s/history.bin" % base_url(server), path, len(PAYLOAD)) and len(sqlite_history[0]) == 4
+    assert sqlite_history[0].filename == path
+    assert sqlite_history.pop().filename == os.path.join(tmp_path, "history (1).bin")
+    assert len(sqlite_history) == 1
+    sqlite_history.close()
+
+
+async def heartbeat_main(url: str, output_dir: str) -> tuple[str, list[float]]:
+    lags = []
+
+    async def heartbeat():
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - before - 0.01)
+
+    task = asyncio.create_task(heartbeat())
+    try:
+        path = await Downloader(output_dir, chunk_size=64 * 1024).async_start(url)
+    finally:
+        task.cancel()
+    return path, lags
+
+
+def test_async_write(server, tmp_path, monkeypatch):
+    written = []
+
+    def slow_write_chunk(fb, hasher, chunk):
+        # a slow disk, the event loop must not wait for it
+        time.sleep(0.2)
+        written.append(len(chunk))
+        fb.write(chunk)
+        hasher.update(chunk)
+
+    monkeypatch.setattr(Downloader, "_Downloader__write_chunk", staticmethod(slow_write_chunk))
+    path, lags = asyncio.run(heartbeat_main("%s/big/file.bin" % base_url(server), str(tmp_path)))
+    with open(path, "rb") as fi_b:
+        assert fi_b.read() == BIG_PAYLOAD
+    assert max(written) == 64 * 1024 and sum(written) == len(BIG_PAYLOAD)
+    assert len(lags) > 20 and max(lags) < 0.1
@@ -0,0 +1,40 @@
+import threading
+import time
+
+from watchdog.events import FileModifiedEvent
+
+from clayutil.futil import FolderMonitor
+
+
+def wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_debounce(tmp_path):
+    monitor = FolderMonitor(str(tmp_path), debounce_time=1.0)
+    calls = []
+    monitor.on_event("modified", is_directory=False)(calls.append)
+    threads = threading.active_count()
+
+    monitor.start()
+    try:
+        # an event storm over many files, each modified many times
+        for _round in range(50):
+            for i in range(200):
+                monitor._event_handler.dispatch(FileModifiedEvent(str(tmp_path / ("%d.txt" % i))))
+        # no thread per event, one pending entry per path
+        assert threading.active_count() <= threads + 8
+        assert len(monitor._pending) == len(monitor._deadlines) == 200
+        assert wait_for(lambda: len(calls) >= 200)
+        time.sleep(1)
+        # debounced to one call per file
+        assert len(calls) == 200 and len({call["src_path"] for call in calls}) == 200
+        assert not monitor._pending and not monitor._deadlines
+    finally:
+        monitor.stop()
+    assert monitor._scheduler is None
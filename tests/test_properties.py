@@ -0,0 +1,225 @@
+import marshal
+import os
+import time
+
+import pytest
+
+from clayutil.futil import FolderMonitor, LazyProperties, Properties, PropertiesCache
+
+CONTENT = "\n".join(
+    [
+        "# generated",
+        "name=clayutil",
+        "count=42",
+        "offset=-7",
+        "version=1.0",
+        "enabled=true",
+        "disabled=false",
+        "",
+        "=a=b",
+        "a==",
+        "empty=",
+        "x#y=z",
+        "no equals",
+        "#a=b",
+        "count=43",
+        "中文=值\r",
+        "last=no newline",
+    ]
+)
+
+
+@pytest.fixture
+def properties_file(tmp_path):
+    filename = tmp_path / "test.properties"
+    filename.write_bytes(CONTENT.encode("utf-8"))
+    return str(filename)
+
+
+def test_lazy(properties_file):
+    p = Properties(properties_file)
+    p.load()
+    with LazyProperties(properties_file) as lp:
+        lp.load()
+        assert "count" in lp and "empty" not in lp
+        assert lp["count"] == 43 and lp["enabled"] is True
+        assert list(lp.items()) == list(p.items())
+        assert len(lp) == len(p)
+
+    lp = LazyProperties(properties_file, infer_integer=False)
+    lp.load()
+    assert lp["offset"] == "-7"
+    lp.close()
+    assert len(lp) == 0
+
+
+def test_dump(properties_file):
+    p = Properties(properties_file)
+    p.load()
+    p["count"] = 44
+    del p["offset"]
+    p["added"] = "yes"
+    assert p.dirty_keys == ["count", "offset", "added"]
+    p.dump()
+    assert p.dirty_keys == [] and not os.path.exists("%s.tmp" % properties_file)
+
+    reloaded = Properties(properties_file)
+    reloaded.load()
+    assert list(reloaded.values()) == list(p.values())
+
+
+def test_journal(properties_file):
+    p = Properties(properties_file, journal=True, journal_limit=4)
+    p.load()
+    with open(properties_file, "rb") as fb:
+        original = fb.read()
+    p["count"] = 44
+    p.pop("offset")
+    p["added"] = True
+    p.dump()
+    # only the journal is written
+    with open(properties_file, "rb") as fb:
+        assert fb.read() == original
+    with open(p.journal_filename, "ab") as fj:
+        fj.write(b'["interrupted", "app')
+
+    reloaded = Properties(properties_file, journal=True)
+    reloaded.load()
+    assert list(reloaded.items()) == list(p.items())
+
+    p["second"] = 2
+    p["third"] = 3
+    p.dump()
+    # over the limit, the journal is compacted into the file
+    assert not os.path.exists(p.journal_filename)
+    reloaded = Properties(properties_file)
+    reloaded.load()
+    assert list(reloaded.values()) == list(p.values())
+
+    # deleted and set again, the keys move to the end
+    p = Properties(properties_file, journal=True)
+    p.load()
+    del p["name"]
+    del p["count"]
+    p["new"] = 1
+    p["count"] = 45
+    p["name"] = "moved"
+    p["new"] = 2
+    p.dump()
+    assert os.path.exists(p.journal_filename)
+    reloaded = Properties(properties_file, journal=True)
+    reloaded.load()
+    assert list(reloaded.items()) == list(p.items())
+    assert list(reloaded)[-3:] == ["new", "count", "name"]
+
+    # a reader which is not in journal mode sees the journaled changes, and compacts them when it dumps
+    plain = Properties(properties_file)
+    plain.load()
+    assert list(plain.items()) == list(p.items())
+    plain["other"] = "x"
+    plain.dump()
+    assert not os.path.exists(p.journal_filename)
+    reloaded = Properties(properties_file)
+    reloaded.load()
+    assert reloaded["name"] == "moved" and reloaded["other"] == "x"
+
+
+def test_cache(properties_file, tmp_path):
+    cache = PropertiesCache.for_file(properties_file)
+    assert PropertiesCache.for_file(os.path.join(os.path.dirname(properties_file), ".", "test.properties")) is cache
+    changes = []
+    cache.on_change(lambda properties, changed_keys: changes.append(sorted(changed_keys)))
+    first = cache.get()
+    assert cache.get() is first and first["count"] == 43
+
+    p = Properties(properties_file)
+    p.load()
+    p["count"] = 44
+    del p["name"]
+    p.dump()
+    assert cache.get()["count"] == 44
+    assert changes == [["count", "name"]]
+
+    # the changes only written to the journal are seen too
+    journaled = Properties(properties_file, journal=True)
+    journaled.load()
+    journaled["journaled"] = 1
+    journaled.dump()
+    assert os.path.exists(journaled.journal_filename)
+    assert cache.get()["journaled"] == 1
+    assert changes[1] == ["journaled"]
+
+    monitor = FolderMonitor(str(tmp_path), debounce_time=0.1)
+    cache.watch(monitor)
+    monitor.start()
+    try:
+        for key, journal in (("added", False), ("journaled", True)):
+            dumped = Properties(properties_file, journal=journal)
+            dumped.load()
+            dumped[key] = 2
+            dumped.dump()
+            for _ in range(50):
+                if changes[-1] == [key]:
+                    break
+                time.sleep(0.1)
+            assert changes[-1] == [key]
+            assert cache.get()[key] == 2
+    finally:
+        monitor.stop()
+
+    # a missing file is not created, the last snapshot is kept until it is back
+    snapshot = cache.get()
+    os.remove(properties_file)
+    os.remove("%s.journal" % properties_file)
+    assert cache.reload() is snapshot and len(changes) == 4
+    assert not os.path.exists(properties_file)
+    with open(properties_file, "w", encoding="utf-8") as pf:
+        pf.write("back=1\n")
+    assert dict(cache.reload()) == {"back": 1}
+    missing = PropertiesCache(str(tmp_path / "missing.properties"))
+    with pytest.raises(FileNotFoundError):
+        missing.get()
+    assert not os.path.exists(tmp_path / "missing.properties")
+
+
+def test_parser(properties_file, tmp_path):
+    # the lines the regular expression parser used to accept
+    expected = {}
+    with open(properties_file, "r", encoding="utf-8") as pf:
+        for i, line in enumerate(pf, 1):
+            m = Properties.pattern.match(line)
+            if m is not None:
+                expected[m.group(1)] = m.group(2)
+            elif line[0] == "#":
+                expected["#%i" % i] = line
+    p = Properties(properties_file, infer_integer=False)
+    p.load()
+    assert list(p.keys()) == list(expected) and p["=a"] == "b" and p["a"] == "="
+
+    cached = Properties(properties_file, cache=True)
+    cached.load()
+    assert list(cached.items()) == list(Properties.load_many([properties_file])[properties_file].items())
+    # a warm start reads the sidecar instead of the file
+    with open(cached.cache_filename, "rb") as fb:
+        cache_key, items = marshal.load(fb)
+    with open(cached.cache_filename, "wb") as fb:
+        marshal.dump((cache_key, [("from", "cache")]), fb)
+    warm = Properties(properties_file, cache=True)
+    warm.load()
+    assert dict(warm) == {"from": "cache"}
+    with open(properties_file, "a", encoding="utf-8") as pf:
+        pf.write("\nappended=1\n")
+    warm = Properties(properties_file, cache=True)
+    warm.load()
+    assert warm["appended"] == 1 and warm["count"] == 43
+
+    filenames = []
+    for i in range(6):
+        filename = str(tmp_path / ("many%d.properties" % i))
+        with open(filename, "w", encoding="utf-8") as pf:
+            pf.write("index=%d\nname=file%d\n" % (i, i))
+        filenames.append(filename)
+    loaded = Properties.load_many(filenames, workers=2)
+    assert list(loaded) == filenames
+    assert [p["index"] for p in loaded.values()] == list(range(6))
+    assert all(p.dirty_keys == [] for p in loaded.values())
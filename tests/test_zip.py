@@ -0,0 +1,137 @@
+import os
+import warnings
+import zipfile
+
+import orjson
+import pytest
+
+from clayutil.futil import compress_as_zip, extract_zip, iter_zip, stream_zip
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    (root / "sub" / "deeper").mkdir(parents=True)
+    (root / "a.txt").write_bytes(b"hello zip\n" * 10000)
+    (root / "sub" / "b.bin").write_bytes(os.urandom(300 * 1024))
+    (root / "sub" / "photo.JPG").write_bytes(b"\xff\xd8" + b"\x00" * 4096)
+    (root / "sub" / "deeper" / "c.txt").write_bytes(b"")
+    (root / "sub" / "deeper" / "d.txt").write_bytes(b"0123456789" * 500000)
+    return root
+
+
+def read_members(zip_filename) -> dict[str, bytes]:
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.testzip() is None
+        return {zinfo.filename: zipf.read(zinfo) for zinfo in zipf.infolist()}
+
+
+def test_parallel(tree, tmp_path):
+    compress_as_zip(str(tree), str(tmp_path / "serial.zip"))
+    compress_as_zip(str(tree), str(tmp_path / "parallel.zip"), workers=4)
+    serial = read_members(tmp_path / "serial.zip")
+    assert list(read_members(tmp_path / "parallel.zip").items()) == list(serial.items())
+    assert serial["sub/deeper/d.txt"] == b"0123456789" * 500000
+
+    with zipfile.ZipFile(tmp_path / "parallel.zip") as zipf:
+        assert zipf.getinfo("sub/photo.JPG").compress_type == zipfile.ZIP_STORED
+        assert zipf.getinfo("a.txt").compress_type == zipfile.ZIP_DEFLATED
+
+    compress_as_zip(str(tree), str(tmp_path / "fast.zip"), compresslevel=1, workers=4, store_extensions=())
+    assert read_members(tmp_path / "fast.zip") == serial
+    with zipfile.ZipFile(tmp_path / "fast.zip") as zipf:
+        assert zipf.getinfo("sub/photo.JPG").compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_incremental(tree, tmp_path):
+    zip_filename = str(tmp_path / "tree.zip")
+    compress_as_zip(str(tree), zip_filename, compresslevel=1, incremental=True)
+    with zipfile.ZipFile(zip_filename) as zipf:
+        level1 = {zinfo.filename: zinfo.compress_size for zinfo in zipf.infolist()}
+
+    (tree / "a.txt").write_bytes(b"changed\n" * 10000)
+    (tree / "sub" / "deeper" / "c.txt").unlink()
+    (tree / "new.txt").write_bytes(b"new\n" * 10000)
+    # the unchanged members are copied as they are, so they keep the compression level of the first run
+    compress_as_zip(str(tree), zip_filename, compresslevel=9, workers=2, incremental=True)
+    compress_as_zip(str(tree), str(tmp_path / "full.zip"))
+    assert read_members(zip_filename) == read_members(tmp_path / "full.zip")
+    with zipfile.ZipFile(zip_filename) as zipf:
+        assert zipf.getinfo("sub/deeper/d.txt").compress_size == level1["sub/deeper/d.txt"]
+        assert zipf.getinfo("a.txt").compress_size < level1["a.txt"]
+    with open("%s.manifest.json" % zip_filename, "rb") as fj:
+        assert sorted(orjson.loads(fj.read())) == sorted(read_members(zip_filename))
+
+    # a manifest which does not match the archive is not trusted
+    compress_as_zip(str(tree), zip_filename, compresslevel=9)
+    assert not os.path.exists("%s.manifest.json" % zip_filename)
+    compress_as_zip(str(tree), zip_filename, incremental=True)
+    assert read_members(zip_filename) == read_members(tmp_path / "full.zip")
+
+
+class Unseekable(object):
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def test_stream(tree, tmp_path):
+    compress_as_zip(str(tree), str(tmp_path / "tree.zip"))
+    expected = read_members(tmp_path / "tree.zip")
+
+    chunks = iter_zip(str(tree))
+    # the first file goes out before the others are read
+    assert next(chunks).startswith(b"PK\x03\x04")
+    with open(tmp_path / "iter.zip", "wb") as fb:
+        fb.write(b"".join(iter_zip(str(tree))))
+    assert list(read_members(tmp_path / "iter.zip").items()) == list(expected.items())
+    with zipfile.ZipFile(tmp_path / "iter.zip") as zipf:
+        assert all(zinfo.flag_bits & 0x08 for zinfo in zipf.infolist())
+        assert zipf.getinfo("sub/photo.JPG").compress_type == zipfile.ZIP_STORED
+
+    writer = Unseekable()
+    stream_zip(str(tree), writer, compresslevel=1)
+    with open(tmp_path / "stream.zip", "wb") as fb:
+        fb.write(writer.data)
+    assert read_members(tmp_path / "stream.zip") == expected
+
+
+def test_extract(tree, tmp_path):
+    compress_as_zip(str(tree), str(tmp_path / "tree.zip"))
+    out = tmp_path / "out"
+    extracted = extract_zip(str(tmp_path / "tree.zip"), str(out), workers=4)
+    assert len(extracted) == 5
+    for filename, arcname in [(os.path.join(root, name), os.path.relpath(os.path.join(root, name), tree)) for root, _dirs, files in os.walk(tree) for name in files]:
+        with open(filename, "rb") as expected, open(out / arcname, "rb") as actual:
+            assert expected.read() == actual.read()
+
+    (out / "a.txt").write_bytes(b"x" * os.path.getsize(out / "a.txt"))
+    (out / "sub" / "b.bin").unlink()
+    extracted = extract_zip(str(tmp_path / "tree.zip"), str(out), workers=2, skip_unchanged=True)
+    assert sorted(extracted) == sorted([str(out / "a.txt"), str(out / "sub" / "b.bin")])
+    assert (out / "a.txt").read_bytes() == (tree / "a.txt").read_bytes()
+
+    for name in ("../evil.txt", "/abs.txt", "sub/../../evil.txt"):
+        with zipfile.ZipFile(tmp_path / "evil.zip", "w") as zipf:
+            zipf.writestr("fine.txt", b"fine")
+            zipf.writestr(name, b"evil")
+        with pytest.raises(ValueError):
+            extract_zip(str(tmp_path / "evil.zip"), str(tmp_path / "evil"))
+        assert not (tmp_path / "evil" / "fine.txt").exists()
+    assert not (tmp_path / "evil.txt").exists()
+
+    # members with the same name, the last one is kept like with extractall()
+    first, last = os.urandom(4 * 1024 * 1024), os.urandom(1024 * 1024)
+    with zipfile.ZipFile(tmp_path / "same.zip", "w") as zipf, warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        zipf.writestr("same.bin", first)
+        zipf.writestr("same.bin", last)
+    for _ in range(3):
+        assert extract_zip(str(tmp_path / "same.zip"), str(tmp_path / "same"), workers=2) == [str(tmp_path / "same" / "same.bin")]
+        assert (tmp_path / "same" / "same.bin").read_bytes() == last